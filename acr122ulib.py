@@ -5,14 +5,27 @@ from smartcard.CardType import AnyCardType
 from smartcard.pcsc.PCSCReader import PCSCReader
 from smartcard.CardConnectionDecorator import CardConnectionDecorator
 from smartcard.Exceptions import NoCardException, CardConnectionException
+from smartcard.scard import (INFINITE, SCARD_E_CANCELLED, SCARD_E_TIMEOUT, SCARD_S_SUCCESS,
+                             SCARD_SCOPE_USER, SCARD_STATE_CHANGED, SCARD_STATE_PRESENT,
+                             SCARD_STATE_UNAWARE, SCardCancel, SCardEstablishContext,
+                             SCardGetErrorMessage, SCardGetStatusChange, SCardReleaseContext)
+from time import perf_counter, sleep
+from bisect import bisect_left
+from collections import Counter, namedtuple
+import json
 import sys
+import threading
+
+from layout import BLOCK_SECTOR, FIRST_BLOCK, SECTOR_BLOCKS
 
 cmdMap = {
     "mute": [0xFF, 0x00, 0x52, 0x00, 0x00],
     "unmute": [0xFF, 0x00, 0x52, 0xFF, 0x00],
     "getuid": [0xFF, 0xCA, 0x00, 0x00, 0x00],
     "firmver": [0xFF, 0x00, 0x48, 0x00, 0x00],
-    "loadkey": [0xFF, 0x82, 0x00, 0x00, 0x06]
+    "loadkey": [0xFF, 0x82, 0x00, 0x00, 0x06],
+    # PN532 InListPassiveTarget of one 106 kbps type A card, by direct transmit
+    "select": [0xFF, 0x00, 0x00, 0x00, 0x04, 0xD4, 0x4A, 0x01, 0x00]
 }
 
 cardnameMap = {
@@ -26,12 +39,198 @@ cardnameMap = {
     "C1 05": "SmartMX with MIFARE Classic 4K"
 }
 
+KEY_TYPES = {0x60: "A", 0x61: "B"}
+
+SectorResult = namedtuple("SectorResult", ["key", "key_type", "data"])
+
+
+def describe_key(result: SectorResult) -> str:
+    """"<key>/<A or B>" of the key that read a sector; sectors taken from a
+    stored dump may have no known key.
+    """
+    if result.key_type is None:
+        return f"{result.key or '?'}/stored"
+    return f"{result.key}/{KEY_TYPES[result.key_type]}"
+
+
+# Upper bounds of the latency histogram buckets, ms
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def command_name(command: list) -> str:
+    ins = command[1]
+    if ins == 0x00:
+        return {0x48: "firmver", 0x52: "buzzer"}.get(command[2], "pseudo")
+    return {0xCA: "getuid", 0x82: "loadkey", 0x86: "auth", 0xB0: "read"}.get(ins, f"{ins:02X}")
+
+
+class ReaderStats:
+    """APDU statistics of the reader layer, see enable_stats().
+
+    Keeps a latency histogram per command, status word counts,
+    authentication failures per sector and retries. Shared by the dump
+    workers of every reader, so updates take a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}  # command -> [count per LATENCY_BUCKETS bucket + overflow]
+            self.time = Counter()  # command -> seconds
+            self.status_words = Counter()
+            self.auth_failures = Counter()  # sector -> failures
+            self.retries = Counter()
+            self.errors = Counter()  # command -> transmit exceptions
+
+    def record(self, command: list, sw, elapsed: float):
+        name = command_name(command)
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (len(LATENCY_BUCKETS) + 1)
+            histogram[bisect_left(LATENCY_BUCKETS, elapsed * 1000)] += 1
+            self.time[name] += elapsed
+            if sw is None:
+                self.errors[name] += 1
+                return
+            self.status_words[f"{sw[0]:02X} {sw[1]:02X}"] += 1
+            if name == "auth" and sw != (0x90, 0x00):
+                self.auth_failures[BLOCK_SECTOR[command[7]]] += 1
+
+    def retry(self, kind: str):
+        with self._lock:
+            self.retries[kind] += 1
+
+    def counters(self) -> dict:
+        """Running totals, cheap enough to show on every dump progress update."""
+        with self._lock:
+            return {
+                "apdus": sum(sum(histogram) for histogram in self.histograms.values()),
+                "seconds": sum(self.time.values()),
+                "auth_failures": sum(self.auth_failures.values()),
+                "retries": sum(self.retries.values()),
+            }
+
+    def summary(self) -> dict:
+        with self._lock:
+            bounds = [f"<={bound}ms" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}ms"]
+            return {
+                "commands": {
+                    name: {
+                        "count": sum(histogram),
+                        "total_ms": round(self.time[name] * 1000, 3),
+                        "mean_ms": round(self.time[name] * 1000 / sum(histogram), 3),
+                        "errors": self.errors[name],
+                        "histogram": {bound: count
+                                      for bound, count in zip(bounds, histogram) if count},
+                    }
+                    for name, histogram in sorted(self.histograms.items())
+                },
+                "status_words": dict(self.status_words.most_common()),
+                "auth_failures": {str(sector): failures
+                                  for sector, failures in sorted(self.auth_failures.items())},
+                "retries": dict(self.retries),
+            }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.summary(), **kwargs)
+
+
+_stats = None  # ReaderStats while instrumentation is on
+
+
+def enable_stats(stats: ReaderStats = None) -> ReaderStats:
+    """Starts recording every APDU sent through transmit() into `stats`."""
+    global _stats
+    _stats = stats or ReaderStats()
+    return _stats
+
+
+def disable_stats():
+    global _stats
+    _stats = None
+
+
+def get_stats():
+    return _stats
+
+
+def transmit(connection: CardConnectionDecorator, command: list):
+    """connection.transmit(), timed into the ReaderStats if enabled.
+
+    Costs one global lookup when instrumentation is off.
+    """
+    stats = _stats
+    if stats is None:
+        return connection.transmit(command)
+    started = perf_counter()
+    try:
+        data, sw1, sw2 = connection.transmit(command)
+    except Exception:
+        stats.record(command, None, perf_counter() - started)
+        raise
+    stats.record(command, (sw1, sw2), perf_counter() - started)
+    return data, sw1, sw2
+
+
+def retried(kind: str):
+    if _stats is not None:
+        _stats.retry(kind)
+
 
 def search_readers() -> list:
     r = readers()
     return r
 
 
+class PresenceMonitor:
+    """Waits for a card to be put on or taken off a reader.
+
+    Blocks in SCardGetStatusChange, so waiting costs no CPU and reacts as
+    soon as PC/SC notices the change, unlike polling create_connection.
+    """
+
+    def __init__(self, reader: PCSCReader):
+        self.reader_name = str(reader)
+        hresult, self.context = SCardEstablishContext(SCARD_SCOPE_USER)
+        if hresult != SCARD_S_SUCCESS:
+            raise CardConnectionException(SCardGetErrorMessage(hresult))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def wait(self, present=True, timeout=None) -> bool:
+        """Returns True once a card is present (or absent with `present=False`),
+        False if `timeout` seconds pass without that or cancel() is called.
+        """
+        timeout = INFINITE if timeout is None else int(timeout * 1000)
+        hresult, states = SCardGetStatusChange(
+            self.context, 0, [(self.reader_name, SCARD_STATE_UNAWARE)])
+        while hresult == SCARD_S_SUCCESS:
+            name, state, atr = states[0]
+            if bool(state & SCARD_STATE_PRESENT) == present:
+                return True
+            hresult, states = SCardGetStatusChange(
+                self.context, timeout, [(name, state & ~SCARD_STATE_CHANGED)])
+        if hresult in (SCARD_E_TIMEOUT, SCARD_E_CANCELLED):
+            return False
+        raise CardConnectionException(SCardGetErrorMessage(hresult))
+
+    def cancel(self):
+        SCardCancel(self.context)
+
+    def close(self):
+        if self.context is not None:
+            SCardReleaseContext(self.context)
+            self.context = None
+
+
 def create_connection(reader: PCSCReader) -> CardConnectionDecorator:
     try:
         connection = reader.createConnection()
@@ -44,7 +243,7 @@ def create_connection(reader: PCSCReader) -> CardConnectionDecorator:
 
 
 def firmver(connection: CardConnectionDecorator):
-    data, sw1, sw2 = connection.transmit(cmdMap["firmver"])
+    data, sw1, sw2 = transmit(connection, cmdMap["firmver"])
     version = ''.join(chr(i) for i in data)+chr(sw1)+chr(sw2)
     return version
 
@@ -62,54 +261,73 @@ def getinfo(connection: CardConnectionDecorator) -> dict:
     }
 
 
+def key_bytes(key: str) -> list:
+    return [int(key[i:i+2], 16) for i in range(0, 12, 2)]
+
+
 def loadkey(connection: CardConnectionDecorator, key: str):
-    COMMAND = cmdMap.get("loadkey")
-    load_key = [key[0:2], key[2:4], key[4:6], key[6:8], key[8:10], key[10:12]]
-    for i in range(6):
-        load_key[i] = int(load_key[i], 16)
-    COMMAND.extend(load_key)
-    data, sw1, sw2 = connection.transmit(COMMAND)
+    COMMAND = cmdMap["loadkey"] + key_bytes(key)
+    data, sw1, sw2 = transmit(connection, COMMAND)
     if (sw1, sw2) == (0x90, 0x0):
         return True
     elif (sw1, sw2) == (0x63, 0x0):
         return False
 
 
+def reselect(connection: CardConnectionDecorator) -> bool:
+    """Selects the card again. A failed authentication leaves a MIFARE
+    Classic card idle, it answers no other command until then.
+    """
+    retried("reselect")
+    data, sw1, sw2 = transmit(connection, cmdMap["select"])
+    # D5 4B, then the number of targets found
+    return (sw1, sw2) == (0x90, 0x0) and data[2:3] == [1]
+
+
 def read_sector(connection: CardConnectionDecorator, sector_num: int):
     COMMAND = [0xFF, 0x86, 0x00, 0x00, 0x05, 0x01,
-               0x00, sector_num*4, 0x60, 0x00]
-    data, sw1, sw2 = connection.transmit(COMMAND)
+               0x00, FIRST_BLOCK[sector_num], 0x60, 0x00]
+    data, sw1, sw2 = transmit(connection, COMMAND)
     if (sw1, sw2) == (0x90, 0x0):
         pass
     elif (sw1, sw2) == (0x63, 0x0):
+        if not reselect(connection):
+            return False
         COMMAND[8] = 0x61
-        data, sw1, sw2 = connection.transmit(COMMAND)
+        retried("auth_key_b")
+        data, sw1, sw2 = transmit(connection, COMMAND)
         if (sw1, sw2) == (0x90, 0x0):
             pass
         else:
             return False
     sector_data = b""
-    for block in range(sector_num*4, sector_num*4+4):
+    first_block = FIRST_BLOCK[sector_num]
+    for block in range(first_block, first_block+SECTOR_BLOCKS[sector_num]):
         COMMAND = [0xFF, 0xB0, 0x00]
         COMMAND.append(block)
         COMMAND.append(16)
-        data, sw1, sw2 = connection.transmit(COMMAND)
+        data, sw1, sw2 = transmit(connection, COMMAND)
         sector_data += bytes(data)
-    print((sw1, sw2))
     if (sw1, sw2) == (0x90, 0x0):
         return sector_data
     else:
         return False
 
 
-def read_sector_with_key(sector: int, key: str, reader=None):
+def read_sector_with_key(sector: int, key: str, reader=None, session=None):
+    if session:
+        return session.read_sector(sector, key)
     if not reader:
         readers = search_readers()
     else:
         readers = [reader]
-    connection = None
-    while connection == None:
-        connection = create_connection(readers[0])
+    connection = create_connection(readers[0])
+    if connection == None:
+        with PresenceMonitor(readers[0]) as monitor:
+            while connection == None:
+                retried("connect")
+                monitor.wait(present=True)
+                connection = create_connection(readers[0])
     if connection == False:
         return False
 
@@ -120,7 +338,7 @@ def read_sector_with_key(sector: int, key: str, reader=None):
 
 
 def mute(connection: CardConnectionDecorator):
-    data, sw1, sw2 = connection.transmit(cmdMap["mute"])
+    data, sw1, sw2 = transmit(connection, cmdMap["mute"])
     if (sw1, sw2) == (0x90, 0x0):
         return True
     else:
@@ -128,7 +346,7 @@ def mute(connection: CardConnectionDecorator):
 
 
 def unmute(connection: CardConnectionDecorator):
-    data, sw1, sw2 = connection.transmit(cmdMap["unmute"])
+    data, sw1, sw2 = transmit(connection, cmdMap["unmute"])
     if (sw1, sw2) == (0x90, 0x0):
         return True
     else:
@@ -136,7 +354,7 @@ def unmute(connection: CardConnectionDecorator):
 
 
 def getuid(connection: CardConnectionDecorator):
-    data, sw1, sw2 = connection.transmit(cmdMap["getuid"])
+    data, sw1, sw2 = transmit(connection, cmdMap["getuid"])
     uid = toHexString(data).replace(" ", "")
     if (sw1, sw2) == (0x90, 0x0):
         return uid
@@ -144,6 +362,181 @@ def getuid(connection: CardConnectionDecorator):
         return None
 
 
+class ReaderSession:
+    """A single PC/SC connection reused for every sector and key.
+
+    Remembers which key sits in the reader's volatile key slot and which
+    sector the card is authenticated for, so repeated LOAD KEY and
+    GENERAL AUTHENTICATE APDUs are skipped.
+    """
+
+    def __init__(self, reader: PCSCReader = None, key_slot: int = 0):
+        self.reader = reader
+        self.key_slot = key_slot
+        self.connection = None
+        self.loaded_key = None
+        self.auth = None  # (sector, key, key type) of the current authentication
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self, attempts=1, interval=0.5):
+        """Connects to the card, `attempts=None` waits for one forever.
+
+        Returns True when connected, None if no card showed up and False on
+        a connection error, like create_connection.
+        """
+        if self.reader is None:
+            readers = search_readers()
+            if not readers:
+                return False
+            self.reader = readers[0]
+        i = 0
+        while attempts is None or i < attempts:
+            connection = create_connection(self.reader)
+            if connection == False:
+                return False
+            if connection != None:
+                self.connection = connection
+                self.auth = None
+                return True
+            i += 1
+            retried("connect")
+            sleep(interval)
+        return None
+
+    def close(self):
+        if self.connection:
+            try:
+                self.connection.disconnect()
+            except CardConnectionException:
+                pass
+        self.connection = None
+        self.auth = None
+
+    def transmit(self, command: list):
+        try:
+            return transmit(self.connection, command)
+        except CardConnectionException:
+            # The card is gone, whatever it was authenticated for is lost
+            self.auth = None
+            raise
+
+    def getuid(self):
+        return getuid(self.connection)
+
+    def getinfo(self) -> dict:
+        return getinfo(self.connection)
+
+    def load_key(self, key: str) -> bool:
+        if self.loaded_key == key:
+            return True
+        command = [0xFF, 0x82, 0x00, self.key_slot, 0x06] + key_bytes(key)
+        data, sw1, sw2 = self.transmit(command)
+        if (sw1, sw2) != (0x90, 0x0):
+            self.loaded_key = None
+            return False
+        self.loaded_key = key
+        return True
+
+    def authenticate(self, sector: int, key: str, key_type=None):
+        """Authenticates `sector`, trying key A (0x60) then key B (0x61)
+        unless `key_type` is given. Returns the key type that worked or False.
+        """
+        key_types = (0x60, 0x61) if key_type is None else (key_type,)
+        if self.auth and self.auth[:2] == (sector, key) and self.auth[2] in key_types:
+            return self.auth[2]
+        if not self.load_key(key):
+            return False
+        for i, auth_type in enumerate(key_types):
+            if i:
+                retried("auth_key_b")
+            command = [0xFF, 0x86, 0x00, 0x00, 0x05, 0x01,
+                       0x00, FIRST_BLOCK[sector], auth_type, self.key_slot]
+            data, sw1, sw2 = self.transmit(command)
+            if (sw1, sw2) == (0x90, 0x0):
+                self.auth = (sector, key, auth_type)
+                return auth_type
+            self.auth = None
+            if not reselect(self.connection):
+                return False
+        return False
+
+    def read_block(self, block: int):
+        data, sw1, sw2 = self.transmit([0xFF, 0xB0, 0x00, block, 16])
+        if (sw1, sw2) == (0x90, 0x0):
+            return bytes(data)
+        return False
+
+    def read_sector(self, sector: int, key: str, key_type=None):
+        if not self.authenticate(sector, key, key_type):
+            return False
+        sector_data = b""
+        first_block = FIRST_BLOCK[sector]
+        for block in range(first_block, first_block+SECTOR_BLOCKS[sector]):
+            block_data = self.read_block(block)
+            if block_data == False:
+                self.auth = None
+                return False
+            sector_data += block_data
+        return sector_data
+
+
+def dictionary_attack(session: ReaderSession, keys, sectors=range(16),
+                      key_types=(0x60, 0x61), known=None, progress=None, cancel=None,
+                      on_found=None) -> dict:
+    """Key-major dictionary attack: every key is loaded once and tried on all
+    sectors that are still locked, so LOAD KEY is sent about once per key
+    instead of once per (sector, key).
+
+    `known` maps sectors to lists of (key, key type) pairs that worked
+    before, each sector's are tried first, in order. `progress(opened, total, attempts)` is called after
+    every authentication attempt and `on_found(sector, result)` for every
+    opened sector, setting the `cancel` event stops the attack.
+    Returns {sector: SectorResult} for opened sectors.
+    """
+    found = {}
+    locked = list(sectors)
+    total = len(locked)
+    attempts = 0
+
+    def attempt(sector, key, key_type):
+        nonlocal attempts
+        data = session.read_sector(sector, key, key_type)
+        attempts += 1
+        if data:
+            found[sector] = SectorResult(key, key_type, data)
+            locked.remove(sector)
+            if on_found:
+                on_found(sector, found[sector])
+        if progress:
+            progress(len(found), total, attempts)
+        return data
+
+    for sector, pairs in (known or {}).items():
+        for key, key_type in pairs:
+            if cancel and cancel.is_set():
+                return found
+            if sector not in locked:
+                break
+            attempt(sector, key, key_type)
+    for key in keys:
+        if not locked or (cancel and cancel.is_set()):
+            break
+        if not session.load_key(key):
+            continue
+        for sector in list(locked):
+            if cancel and cancel.is_set():
+                return found
+            for key_type in key_types:
+                if attempt(sector, key, key_type):
+                    break
+    return found
+
+
 if __name__ == "__main__":
     print(toHexString(list(read_sector_with_key(0, "ffffffffffff"))))
     print(toHexString(list(read_sector_with_key(4, "e56ac127dd45"))))
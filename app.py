@@ -1,141 +1,75 @@
 import os
 import sys
-from PyQt5 import QtWidgets
-from datetime import datetime
-from time import sleep
-from smartcard.Exceptions import NoCardException, CardConnectionException
+from PyQt5 import QtCore, QtWidgets
 
 import design
-from acr122ulib import *
+from cardtable import CardTableWindow
+from card import Card, available_fields
+from dumpstore import DumpStore
+from keystore import KeyStore
+from parsecache import ParseCache
+from workers import BalanceThread, DumpThread, KioskThread, ParseThread
 
-
-keys = []
-
-
-class Card:
-    def __init__(self, dump, uid=None):
-        self._dump = dump
-        if uid:
-            self._uid = uid.encode()
-        else:
-            self._uid = None
-
-    @property
-    def dump(self):
-        return self._dump
-
-    @property
-    def uid(self):
-        return self._uid
-
-    def verify_dump(self):
-        un_dump = self.dump
-        dump_correct = True
-        # TODO: some conditions
-        if dump_correct:
-            return True
-        else:
-            return False
-
-    def get_uid(self):  # sec 0, blk 0, 0-7 bytes
-        if self.uid == None:
-            return self.get_data(0, 0, 0, 7)
-        else:
-            return self.uid
-
-    def _get_addr(self, sec: int, blk: int, offset: int):
-        return sec * 16 * 4 + blk * 16 + offset
-
-    def get_data(self, sec: int, blk: int, start: int, end: int):
-        return self.dump[self._get_addr(sec, blk, start):self._get_addr(sec, blk, end)]
-
-    def get_number(self):
-
-        uid = self.get_uid()
-
-        def calc_num(b_array_uid: list):
-            j = 0
-            for i, c in enumerate(b_array_uid):
-                j += (c & 255) << (i << 3)
-            return j
-
-        def calc_verity(num: str):
-            num += "0"
-            lenght = len(num)
-            i = (lenght - 1) % 2
-            i2 = 0
-            for count, num_i in enumerate(num):
-                num_i = int(num_i)
-                if i == (lenght - count - 1) % 2:
-                    num_i *= 2
-                i2 = num_i % 10 + num_i//10 + i2
-            return 10 - (i2 % 10)
-
-        num = str("96433078") + str(calc_num(uid))
-        num += str(calc_verity(num))
-
-        return num
-
-    def get_balance(self):  # 4 sec, 0 blk, 0-3 bytes
-        return int.from_bytes(self.get_data(4, 0, 0, 3), "little")//100
-
-    def get_ekp_num(self):  # 32 sec, 0 blk, 1-8 bytes (128 blk)
-        print(self.get_data(32, 0, 1, 8))
-        return int.from_bytes(self.get_data(32, 0, 1, 8), "big")
-
-    def get_last_day(self):  # 8 sec, 0 blk, 10-13 bytes (32 blk)
-        b_date = self.get_data(8, 0, 10, 13)
-        return f"{int(b_date[2])-1}.{int(b_date[1])}.{int(b_date[0])+2000}"
-
-    def get_passport(self):  # 8 sec, 1 blk, 3-8 bytes serial, 9-12 bytes number
-        try:
-            serial = self.get_data(8, 1, 3, 8).decode().replace(" ", "")
-            number = str(int.from_bytes(self.get_data(8, 1, 9, 12), "little"))
-            return int(serial+number)
-        except:
-            return None
-
-    def get_lastname(self):  # 13 sec, 0 blk, 1-35 bytes
-        return self.get_data(13, 0, 1, 34).rstrip().rstrip(b'\x00').decode("cp1251")
-
-    def get_firstname_and_patronymic(self):  # 14 sec, 0 blk, 1-48 bytes
-        return self.get_data(14, 0, 1, 47).rstrip().rstrip(b'\x00').decode("cp1251")
-
-    def get_underground_rides(self):  # 9 sec, 0 blk, 0-4 bytes
-        return str(int.from_bytes(self.get_data(9, 0, 0, 4), "little"))
-
-    def get_last_land_ride(self):  # 12 sec, 0 blk, 9-15 bytes
-        print(self.get_data(12, 0, 0, 32))
-        pass  # TODO
-
-    def get_last_underground_ride(self):  # 9 sec, 2 blk, 0-3 bytes
-        print(self.get_data(9, 2, 0, 3))
-
-    def get_last_ride_time(self):  # 5 sec, 0 blk, 0-3 bytes
-        pass  # TODO
-
-    def get_last_count(self):  # 5 sec, 0 blk, 6-8 bytes
-        pass  # TODO
-
-    def get_last_balance_top_up(self):  # 4 sec, 2 blk, 8-11 bytes
-        pass  # TODO
-
-    def get_last_balance_top_up_date(self):  # 4 sec, 2 blk, 2-5 bytes
-        pass  # TODO
-
-    def get_activation_time(self):  # 5 sec, 0 blk, 0-3 bytes
-        pass  # TODO
+# Seconds a dump may take, sectors are read by priority and a card that
+# resists the key dictionary is shown as far as it was read
+DUMP_BUDGET = 30.0
+# How often to look for readers plugged in or out, in milliseconds
+READER_CHECK_MS = 2000
 
 
 class PlantainParserApp(QtWidgets.QMainWindow, design.Ui_MainWindow):
-    def __init__(self):
+    def __init__(self, kiosk=False):
         super().__init__()
         self.Card = None
+        self.dump_thread = None
+        self.parse_thread = None
+        self.key_store = KeyStore()
+        self.parse_cache = ParseCache()
         self.setupUi(self)
         self.openButton.clicked.connect(self.select_dump)
         self.parse_button.clicked.connect(self.parse_dump)
-        self.dumpButton.setEnabled(False)
         self.dumpButton.clicked.connect(self.create_dump)
+        # Not in design.py: reads just the number and balance, a few APDUs
+        self.balanceButton = QtWidgets.QPushButton("Баланс", self.groupBox_2)
+        self.horizontalLayout_2.addWidget(self.balanceButton)
+        self.balanceButton.clicked.connect(self.read_balance)
+        self.balance_thread = None
+        # Not in design.py: opens a table of every dump in a folder
+        self.folderButton = QtWidgets.QPushButton("Папка…", self.groupBox_2)
+        self.horizontalLayout.addWidget(self.folderButton)
+        self.folderButton.clicked.connect(self.select_folder)
+        self.table_window = None
+        self.kiosk_thread = None
+        # Dumping is enabled while the key file and a reader are there,
+        # checked again as readers are plugged in and out
+        self.reader_timer = QtCore.QTimer(self)
+        self.reader_timer.setInterval(READER_CHECK_MS)
+        self.reader_timer.timeout.connect(self.update_reader_buttons)
+        if kiosk:
+            # The kiosk owns the readers
+            self.dumpButton.setEnabled(False)
+            self.balanceButton.setEnabled(False)
+            self.start_kiosk()
+        else:
+            self.update_reader_buttons()
+            self.reader_timer.start()
+
+    def start_kiosk(self) -> None:
+        self.kiosk_thread = KioskThread(self.key_store, store=DumpStore(), parent=self)
+        self.kiosk_thread.dumped.connect(self.dump_created)
+        # Shown without a dialog, so a failed tap doesn't hold up the next card,
+        # until the next card is dumped
+        self.kiosk_thread.failed.connect(self.statusBar().showMessage)
+        self.kiosk_thread.dumped.connect(self.statusBar().clearMessage)
+        self.kiosk_thread.start()
+
+    def closeEvent(self, event) -> None:
+        if self.kiosk_thread is not None:
+            self.kiosk_thread.cancel()
+            self.kiosk_thread.wait()
+        if self.table_window is not None:
+            self.table_window.close()
+        super().closeEvent(event)
 
     def display_error(self, error_message: str) -> None:
         self.error_dialog = QtWidgets.QErrorMessage()
@@ -150,120 +84,181 @@ class PlantainParserApp(QtWidgets.QMainWindow, design.Ui_MainWindow):
         self.passport_view.setPlainText("")
         self.last_day_view.setPlainText("")
 
-    def create_dump(self) -> bool:
+    def update_reader_buttons(self) -> None:
+        from acr122ulib import search_readers
+
         try:
-            with open("keys.txt", "r") as keyfile:
-                for line in keyfile.readlines():
-                    if line.strip() not in keys:
-                        keys.append(line.strip())
-        except FileNotFoundError:
+            ready = os.path.exists(self.key_store.keys_path) and len(search_readers()) > 0
+        except Exception:  # no PC/SC service running
+            ready = False
+        # A running dump or balance read keeps its button, it cancels it
+        if self.dump_thread is None:
+            self.dumpButton.setEnabled(ready)
+        if self.balance_thread is None:
+            self.balanceButton.setEnabled(ready)
+
+    def find_reader(self):
+        """The first reader, None after telling the operator what's missing."""
+        if not os.path.exists(self.key_store.keys_path):
             self.display_error("Файл ключей не найден!")
-            return False
+            return None
+        from acr122ulib import search_readers
+
         readers = search_readers()
-        print(readers)
         if len(readers) == 0:
             self.display_error("Не найдено ни одного ридера!")
             return None
-        connection = None
-        i = 0
-        while connection == None:
-            print(f"Connection attempt # {i}")
-            connection = create_connection(readers[0])
-            print(connection)
-            sleep(0.5)
-            i += 1
-
-        if connection == False:
-            self.display_error("Ошибка соединения!")
-            return None
-        try:
-            print("1")
-            uid = getuid(connection)
-            print("2")
-            info = getinfo(connection)
-            print("3")
-            if "MIFARE" not in info["Name"]:
-                return None
-            if "1K" in info["Name"]:
-                size = 1024
-            else:
-                size = 4096
-            dump = b""
-            for i in range(16):
-                print(f"Reading sector {i}")
-                dump1 = False
-                for key in keys:
-                    print(f"    attempt to auth with key {key}")
-                    dump1 = read_sector_with_key(i, key)
-                    if dump1:
-                        break
-                if not dump1:
-                    self.display_error(f"No key for sector {i}!")
-                    return None
-                dump += dump1
-            self.Card = Card(dump, uid)
-            return self.parse_dump(dump=dump)
-        except NoCardException:
+        return readers[0]
+
+    def create_dump(self) -> bool:
+        if self.dump_thread is not None:
+            self.dump_thread.cancel()
             return False
+        reader = self.find_reader()
+        if reader is None:
+            return False
+        self.dump_thread = DumpThread(self.key_store, reader, DUMP_BUDGET, parent=self)
+        self.dump_thread.progress.connect(self.show_dump_progress)
+        self.dump_thread.preview.connect(self.show_dump_preview)
+        self.dump_thread.dumped.connect(self.dump_created)
+        self.dump_thread.failed.connect(self.display_error)
+        self.dump_thread.finished.connect(self.dump_thread_finished)
+        self.dumpButton.setText("Отменить")
+        self.dump_thread.start()
+        return True
 
-    def parse_dump(self, dump=None):
-        self.clean_card_fields()
-        if not dump:
-            p_dump_filename = self.file_name_view.toPlainText()
-            print(p_dump_filename)
-            try:
-                with open(p_dump_filename, "rb") as p_dump_file:
-                    self.Card = Card(p_dump_file.read())
-                    if not self.Card.verify_dump():
-                        self.Card = None
-                        return self.display_error('Файл не является валидным дампом!')
-                    self.creation_date_view.setPlainText(datetime.fromtimestamp(
-                        os.path.getmtime(p_dump_filename)).strftime('%Y-%m-%d %H:%M:%S'))
-                    self.parse_button.setEnabled(True)
-            except FileNotFoundError as e:
-                return self.display_error('Файл не найден!\n' + str(p_dump_filename) + "\n" + str(e))
-
-        if self.Card is None:
-            self.display_error("Файл дампа не выбран")
+    def read_balance(self) -> bool:
+        if self.balance_thread is not None:
+            self.balance_thread.cancel()
+            return False
+        reader = self.find_reader()
+        if reader is None:
             return False
+        self.balance_thread = BalanceThread(self.key_store, reader, parent=self)
+        self.balance_thread.read.connect(self.show_dump_preview)
+        self.balance_thread.failed.connect(self.display_error)
+        self.balance_thread.finished.connect(self.balance_thread_finished)
+        self.balanceButton.setText("Отменить")
+        self.balance_thread.start()
+        return True
+
+    def balance_thread_finished(self) -> None:
+        self.balance_thread.deleteLater()
+        self.balance_thread = None
+        self.balanceButton.setText("Баланс")
+
+    def show_dump_progress(self, opened: int, total: int, attempts: int, elapsed: float) -> None:
+        text = f"Сектор {opened} из {total}, попыток: {attempts}, {elapsed:.1f} с"
+        from acr122ulib import get_stats
+
+        stats = get_stats()
+        if stats is not None:
+            counters = stats.counters()
+            text += (f"\nAPDU: {counters['apdus']} за {counters['seconds']:.1f} с, "
+                     f"ошибок авторизации: {counters['auth_failures']}")
+        self.creation_date_view_2.setPlainText(text)
+
+    def show_dump_preview(self, record: dict) -> None:
+        self.clean_card_fields()
+        self.show_record(record)
 
-        balance = str(self.Card.get_balance())
-        self.balance_view.setPlainText(balance)
-        full_name = str(self.Card.get_lastname() + " " +
-                        self.Card.get_firstname_and_patronymic())
+    def dump_thread_finished(self) -> None:
+        self.dump_thread.deleteLater()
+        self.dump_thread = None
+        self.dumpButton.setText("Создать дамп")
 
-        if full_name == " ":
-            card_type = "Подорожник"
+    def dump_created(self, result) -> None:
+        from dumper import sector_count
+
+        self.clean_card_fields()
+        if result.error:
+            # Partial dump, show only what the read sectors hold
+            card = Card(result.sparse)
+            fields = available_fields(result.sparse.sectors, sector_count(result.info))
+            self.show_card(card, card.to_dict(fields))
         else:
-            card_type = "Льготный проездной"
-            self.fio_view.setPlainText(full_name)
-
-        ekp_num = self.Card.get_ekp_num()
-        if ekp_num:
-            card_type = "Единая карта Петербуржца + " + card_type
-            self.ekp_num_view.setPlainText(str(ekp_num))
-
-        self.card_type_view.setPlainText(card_type)
-        card_num = str(self.Card.get_number())
-        self.card_num_view.setPlainText(card_num)
-        if "Подорожник" not in card_type:
-            passport_num = str(self.Card.get_passport())
-            self.passport_view.setPlainText(passport_num)
-            last_day = str(self.Card.get_last_day())
-            self.last_day_view.setPlainText(last_day)
+            card = Card(result.dump)
+            self.show_card(card, card.to_dict())
 
+    def parse_dump(self) -> bool:
+        p_dump_filename = self.file_name_view.toPlainText()
+        print(p_dump_filename)
+        if not p_dump_filename:
+            self.display_error("Файл дампа не выбран")
+            return False
+        self.clean_card_fields()
+        self.parse_button.setEnabled(False)
+        self.parse_thread = ParseThread(p_dump_filename, self.parse_cache, parent=self)
+        self.parse_thread.parsed.connect(self.show_card)
+        self.parse_thread.failed.connect(self.display_error)
+        self.parse_thread.finished.connect(self.parse_thread_finished)
+        self.parse_thread.start()
         return True
 
+    def parse_thread_finished(self) -> None:
+        self.parse_thread.deleteLater()
+        self.parse_thread = None
+        self.parse_button.setEnabled(True)
+
+    def show_card(self, card: Card, record: dict, created: str = None) -> None:
+        self.Card = card
+        if created:
+            self.creation_date_view.setPlainText(created)
+        self.show_record(record)
+
+    def show_record(self, record: dict) -> None:
+        # Partial records from a dump in progress have only some of the fields
+        if "balance" in record:
+            self.balance_view.setPlainText(str(record["balance"]))
+        if record.get("name"):
+            self.fio_view.setPlainText(record["name"])
+        if record.get("ekp_num"):
+            self.ekp_num_view.setPlainText(str(record["ekp_num"]))
+        if "card_type" in record:
+            self.card_type_view.setPlainText(record["card_type"])
+        if "number" in record:
+            self.card_num_view.setPlainText(record["number"])
+        if "Подорожник" not in record.get("card_type", "Подорожник"):
+            if "passport" in record:
+                self.passport_view.setPlainText(str(record["passport"]))
+            if "last_day" in record:
+                self.last_day_view.setPlainText(record["last_day"])
+
     def select_dump(self) -> bool:
         p_dump_filename = QtWidgets.QFileDialog.getOpenFileName(
             self, "Выберите файл дампа")
         print(type(p_dump_filename), p_dump_filename)
         self.file_name_view.setPlainText(p_dump_filename[0])
 
+    def select_folder(self) -> None:
+        directory = QtWidgets.QFileDialog.getExistingDirectory(
+            self, "Выберите папку с дампами")
+        if not directory:
+            return
+        if self.table_window is None:
+            self.table_window = CardTableWindow(self.parse_cache.path, parent=self)
+            self.table_window.opened.connect(self.open_dump)
+        self.table_window.load(directory)
+        self.table_window.show()
+        self.table_window.raise_()
+
+    def open_dump(self, path: str) -> None:
+        if self.parse_thread is not None:
+            return
+        self.file_name_view.setPlainText(path)
+        self.parse_dump()
+
 
 def main():
     app = QtWidgets.QApplication(sys.argv)
-    window = PlantainParserApp()
+    if "--apdu-stats" in sys.argv:
+        # Shows APDU counters while dumping and prints a summary on exit
+        from acr122ulib import enable_stats
+
+        stats = enable_stats()
+        app.aboutToQuit.connect(lambda: print(stats.to_json(indent=2)))
+    # --kiosk dumps and shows every card tapped on the readers, no button needed
+    window = PlantainParserApp(kiosk="--kiosk" in sys.argv)
     window.show()
     app.exec_()
 
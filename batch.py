@@ -0,0 +1,281 @@
+# argparse, csv, glob, json, shutil and concurrent.futures are imported
+# where they're used: worker processes import this module and should start fast
+import os
+import sys
+from collections import Counter, deque
+from datetime import datetime
+from itertools import islice
+from time import monotonic
+
+from card import RECORD_FIELDS, Card
+from formats import load_file, map_file
+from validate import INVALID
+
+
+FIELDS = ["path", "offset", "created", "card_type", "balance", "number",
+          "ekp_num", "name", "passport", "last_day", "error"]
+
+
+def iter_dump_paths(sources):
+    # Directories are walked lazily, so the whole corpus is never listed in memory
+    import glob
+
+    for source in sources:
+        if glob.has_magic(source):
+            matches = glob.iglob(source, recursive=True)
+        else:
+            matches = [source]
+        for path in matches:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        yield os.path.join(root, name)
+            else:
+                yield path
+
+
+def iter_archive_entries(paths, size: int):
+    # Every `size` bytes of each archive is a separate dump
+    for path in paths:
+        try:
+            length = os.path.getsize(path)
+        except OSError:
+            yield path, 0, size
+            continue
+        for offset in range(0, length - size + 1, size):
+            yield path, offset, size
+
+
+def parse_file(path: str, offset=0, size=None, view=None, fields=None, cache=None) -> dict:
+    record = {"path": path, "offset": offset, "created": None}
+    record.update(dict.fromkeys(fields or RECORD_FIELDS))
+    record["error"] = None
+    try:
+        if view is None:
+            view = load_file(path)
+        card = Card(view, offset=offset, size=size)
+        record["created"] = datetime.fromtimestamp(
+            os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S')
+        if cache is not None:
+            cached = cache.record(card)
+            record.update((name, cached[name]) for name in record if name in cached)
+            return record
+        reason = card.validate()
+        if reason:
+            record["error"] = INVALID + reason
+        else:
+            record.update(card.to_dict(fields))
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+
+_caches = {}  # cache path -> ParseCache of this worker process
+
+
+def parse_chunk(entries: list, fields=None, cache_path=None) -> list:
+    # Consecutive entries of one archive share a single mapping
+    cache = None
+    if cache_path:
+        cache = _caches.get(cache_path)
+        if cache is None:
+            from parsecache import ParseCache
+
+            cache = _caches[cache_path] = ParseCache(cache_path)
+    records = []
+    mapped_path, view = None, None
+    for entry in entries:
+        if isinstance(entry, str):
+            records.append(parse_file(entry, fields=fields, cache=cache))
+            continue
+        path, offset, size = entry
+        if path != mapped_path:
+            mapped_path = path
+            try:
+                view = map_file(path)
+            except OSError:
+                view = None
+        records.append(parse_file(path, offset, size, view, fields, cache))
+    if cache is not None:
+        # One write transaction per chunk
+        cache.flush()
+    return records
+
+
+def _chunks(iterable, size: int):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def map_chunks(function, items, workers=None, chunksize=64, *args, mp_context=None):
+    """Yields function(chunk, *args) for chunks of `items`, in input order.
+
+    With more than one worker the chunks run in a process pool, but only a
+    bounded window of them is in flight at any time, so memory does not
+    grow with the size of the corpus. `mp_context` starts the pool's
+    processes, e.g. "spawn" ones when called from a thread.
+    """
+    if workers == 1:
+        for chunk in _chunks(items, chunksize):
+            yield function(chunk, *args)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers, mp_context=mp_context) as pool:
+        pending = deque()
+        for chunk in _chunks(items, chunksize):
+            pending.append(pool.submit(function, chunk, *args))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def parse_files(paths, workers=None, chunksize=64, fields=None, cache_path=None,
+                mp_context=None):
+    """Yields one record per path or (path, offset, size) entry, in input order,
+    parsed in `workers` processes (see map_chunks). With `cache_path`
+    records of dumps parsed before come from that ParseCache.
+    """
+    for records in map_chunks(parse_chunk, paths, workers, chunksize, fields, cache_path,
+                              mp_context=mp_context):
+        yield from records
+
+
+def quarantine(records, directory: str):
+    """Moves dumps that failed validation to `directory`/<reason>/ as the
+    records pass by.
+    """
+    import shutil
+
+    for record in records:
+        error = record["error"]
+        if error and error.startswith(INVALID):
+            target_dir = os.path.join(directory, error[len(INVALID):])
+            os.makedirs(target_dir, exist_ok=True)
+            name, ext = os.path.splitext(os.path.basename(record["path"]))
+            target = os.path.join(target_dir, name + ext)
+            i = 1
+            while os.path.exists(target):
+                target = os.path.join(target_dir, f"{name}_{i}{ext}")
+                i += 1
+            try:
+                shutil.move(record["path"], target)
+            except OSError as e:
+                print(f"Can't quarantine {record['path']}: {e}", file=sys.stderr)
+        yield record
+
+
+class Progress:
+    def __init__(self, stream=sys.stderr, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.count = 0
+        self.errors = 0
+        self.invalid = Counter()  # validate.REASONS -> dumps
+        self.started = monotonic()
+        self._last_report = self.started
+
+    @property
+    def rate(self) -> float:
+        elapsed = monotonic() - self.started
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def update(self, record: dict):
+        self.count += 1
+        if record["error"]:
+            self.errors += 1
+            if record["error"].startswith(INVALID):
+                self.invalid[record["error"][len(INVALID):]] += 1
+        now = monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report(end="\r")
+
+    def report(self, end="\n"):
+        self.stream.write(
+            f"{self.count} dumps, {self.errors} errors, {self.rate:.0f} dumps/s{end}")
+        if end == "\n" and self.invalid:
+            self.stream.write("invalid: " + ", ".join(
+                f"{reason} {count}" for reason, count in self.invalid.most_common()) + "\n")
+        self.stream.flush()
+
+
+def write_records(records, output, fmt="jsonl", progress=None, fieldnames=FIELDS):
+    if fmt == "csv":
+        import csv
+
+        writer = csv.DictWriter(output, fieldnames=fieldnames)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        import json
+
+        def write(record):
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+    for record in records:
+        write(record)
+        if progress:
+            progress.update(record)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Parse Plantain dumps without the GUI")
+    parser.add_argument("sources", nargs="+",
+                        help="dump files, directories or glob patterns")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file, stdout by default")
+    parser.add_argument("-f", "--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes, defaults to the number of CPUs")
+    parser.add_argument("--chunksize", type=int, default=64,
+                        help="dumps handed to a worker at once")
+    parser.add_argument("--archive", type=int, metavar="SIZE",
+                        help="treat sources as concatenated archives of SIZE-byte dumps")
+    parser.add_argument("--fields", type=lambda value: value.split(","),
+                        help="comma separated card fields to decode, all by default: "
+                        + ",".join(RECORD_FIELDS))
+    parser.add_argument("--cache", nargs="?", const="parsecache.sqlite", metavar="FILE",
+                        help="reuse records of dumps parsed before from a SQLite cache, "
+                        "parsecache.sqlite by default")
+    parser.add_argument("--quarantine", metavar="DIR",
+                        help="move dumps failing validation to DIR/<reason>/")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="don't report throughput to stderr")
+    args = parser.parse_args(argv)
+    fieldnames = FIELDS
+    if args.fields:
+        unknown = set(args.fields) - set(RECORD_FIELDS)
+        if unknown:
+            parser.error("unknown fields: " + ",".join(sorted(unknown)))
+        fieldnames = ["path", "offset", "created"] + args.fields + ["error"]
+    if args.quarantine and args.archive:
+        parser.error("--quarantine can't move dumps out of archives")
+
+    progress = None if args.quiet else Progress()
+    paths = iter_dump_paths(args.sources)
+    if args.archive:
+        paths = iter_archive_entries(paths, args.archive)
+    records = parse_files(paths, args.workers, args.chunksize, args.fields, args.cache)
+    if args.quarantine:
+        records = quarantine(records, args.quarantine)
+    if args.output == "-":
+        write_records(records, sys.stdout, args.format, progress, fieldnames)
+    else:
+        with open(args.output, "w", encoding="utf-8", newline="") as output:
+            write_records(records, output, args.format, progress, fieldnames)
+    if progress:
+        progress.report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
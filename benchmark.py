@@ -0,0 +1,333 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from card import Card
+from layout import SECTOR_BLOCKS, SECTOR_COUNT, addr
+
+
+def make_dump(rng: random.Random, size=1024) -> bytes:
+    """A synthetic Plantain dump with random UID, balance, rides and date."""
+    dump = bytearray(rng.getrandbits(8) for _ in range(size))
+    uid = bytes(rng.getrandbits(8) for _ in range(4))
+    dump[0:4] = uid
+    dump[4] = uid[0] ^ uid[1] ^ uid[2] ^ uid[3]
+    dump[5:7] = b"\x08\x04"
+    dump[13 * 64 + 1:13 * 64 + 35] = bytes(34)
+    dump[14 * 64 + 1:14 * 64 + 47] = bytes(46)
+    if size > 2048:
+        dump[32 * 64 + 1:32 * 64 + 8] = bytes(7)
+    for sector in range(SECTOR_COUNT[size]):
+        # Transport configuration access bits, so the dump passes validation
+        trailer = addr(sector, SECTOR_BLOCKS[sector] - 1, 6)
+        dump[trailer:trailer + 4] = b"\xff\x07\x80\x69"
+    return bytes(dump)
+
+
+def timed(func, *args):
+    started = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - started
+
+
+def bench_columnar(args):
+    import columnar
+
+    rng = random.Random(args.seed)
+    dumps = [make_dump(rng, args.size) for _ in range(args.count)]
+
+    def per_card():
+        return [(card.get_balance(), int(card.get_underground_rides()),
+                 card.get_last_day(), card.get_number())
+                for card in map(Card, dumps)]
+
+    expected, card_time = timed(per_card)
+    array, stack_time = timed(columnar.stack_dumps, dumps, args.size)
+    columns, decode_time = timed(columnar.decode_columns, array)
+
+    numbers = columnar.format_numbers(columns)
+    for i, (balance, rides, last_day, number) in enumerate(expected):
+        assert columns["balance"][i] == balance
+        assert columns["underground_rides"][i] == rides
+        assert last_day == (f"{columns['last_day_day'][i]}.{columns['last_day_month'][i]}"
+                            f".{columns['last_day_year'][i]}")
+        assert numbers[i] == number
+
+    print(f"{args.count} dumps of {args.size} bytes")
+    print(f"per-Card getters: {card_time:.3f} s ({args.count / card_time:.0f} dumps/s)")
+    print(f"stack_dumps:      {stack_time:.3f} s")
+    print(f"decode_columns:   {decode_time:.3f} s ({args.count / decode_time:.0f} dumps/s)")
+    print(f"speedup:          {card_time / decode_time:.1f}x decode, "
+          f"{card_time / (stack_time + decode_time):.1f}x with stacking")
+    return 0
+
+
+def random_key(rng: random.Random) -> str:
+    return f"{rng.getrandbits(48):012x}"
+
+
+def legacy_dump(reader, keys: list):
+    """The reading loop of the original app: every attempt reconnects and loads the key."""
+    from acr122ulib import read_sector_with_key
+
+    dump = b""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for sector in range(16):
+            sector_data = False
+            for key in keys:
+                sector_data = read_sector_with_key(sector, key, reader)
+                if sector_data:
+                    break
+            if not sector_data:
+                return None
+            dump += sector_data
+    return dump
+
+
+def bench_reader(args):
+    from acr122ulib import ReaderSession
+    from dumper import dump_card
+    from keystore import KeyStore
+    from simulator import SimulatedCard, SimulatedReader
+
+    rng = random.Random(args.seed)
+    card_keys = [random_key(rng) for _ in range(args.distinct)]
+    card = SimulatedCard(make_dump(rng, args.size),
+                         {sector: (rng.choice(card_keys), rng.choice(card_keys))
+                          for sector in range(40)})
+    expected = b"".join(card.read_block(block) for block in range(args.size // 16))
+    latency = args.latency / 1000
+
+    print(f"{args.size} byte card, {args.distinct} distinct keys, "
+          f"{args.latency:g} ms per APDU")
+    print(f"{'dictionary':>10} {'method':<20} {'time, s':>9} {'APDUs':>8} "
+          f"{'auths':>8} {'failed':>8} {'connects':>8}")
+    for size in args.keys:
+        keys = [random_key(rng) for _ in range(max(size - len(card_keys), 0))]
+        for key in card_keys:
+            keys.insert(rng.randrange(len(keys) + 1), key)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            keys_path = os.path.join(tmp, "keys.txt")
+            with open(keys_path, "w") as keyfile:
+                keyfile.write("\n".join(keys))
+            key_store = KeyStore(keys_path, os.path.join(tmp, "keystats.json"))
+
+            def store_dump():
+                with ReaderSession(reader) as session:
+                    session.connect()
+                    return dump_card(session, key_store).dump
+
+            methods = [("dump_card, cold", store_dump), ("dump_card, warm", store_dump)]
+            if args.size == 1024:
+                methods.insert(0, ("read_sector_with_key", lambda: legacy_dump(reader, keys)))
+            for name, method in methods:
+                reader = SimulatedReader(card, latency)
+                dump, elapsed = timed(method)
+                assert dump == expected, f"{name} read a wrong dump"
+                stats = reader.stats
+                print(f"{size:>10} {name:<20} {elapsed:>9.3f} {reader.apdus():>8} "
+                      f"{stats['auth_attempts']:>8} {stats['auth_failures']:>8} "
+                      f"{stats['connect']:>8}")
+    return 0
+
+
+def write_formats(dump: bytes, directory: str, name: str) -> dict:
+    """`dump` as .bin, .eml and proxmark3 JSON files, returns their paths by format."""
+    blocks = [dump[i:i + 16].hex().upper() for i in range(0, len(dump), 16)]
+    paths = {fmt: os.path.join(directory, f"{name}.{fmt}") for fmt in ("bin", "eml", "json")}
+    with open(paths["bin"], "wb") as dump_file:
+        dump_file.write(dump)
+    with open(paths["eml"], "w") as dump_file:
+        dump_file.write("\n".join(blocks) + "\n")
+    with open(paths["json"], "w") as dump_file:
+        json.dump({"Created": "proxmark3", "FileType": "mfcard",
+                   "blocks": {str(i): block for i, block in enumerate(blocks)}},
+                  dump_file, indent=2)
+    return paths
+
+
+def per_line_eml(path: str) -> bytes:
+    """How .eml dumps used to be converted, for comparison."""
+    with open(path, "r") as dump_file:
+        return b"".join(bytes.fromhex(line.strip()) for line in dump_file)
+
+
+def bench_formats(args):
+    from formats import load_file
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        dumps = [make_dump(rng, args.size) for _ in range(args.count)]
+        files = [write_formats(dump, tmp, f"{i:06d}") for i, dump in enumerate(dumps)]
+        big = make_dump(rng, args.size) * args.large
+        big_paths = write_formats(big, tmp, "large")
+
+        print(f"{args.count} dumps of {args.size} bytes, "
+              f"large files of {args.large} dumps ({len(big) / 1e6:.1f} MB decoded)")
+        loaders = [("bin", load_file), ("eml", load_file), ("json", load_file),
+                   ("eml per line", per_line_eml)]
+        for name, loader in loaders:
+            fmt = name.split()[0]
+            loaded, elapsed = timed(lambda: [loader(paths[fmt]) for paths in files])
+            assert all(bytes(dump) == expected for dump, expected in zip(loaded, dumps))
+            large, large_elapsed = timed(loader, big_paths[fmt])
+            assert bytes(large) == big
+            size = os.path.getsize(big_paths[fmt])
+            print(f"{name:<13} {args.count / elapsed:>9.0f} dumps/s, large file "
+                  f"{large_elapsed:.3f} s ({size / large_elapsed / 1e6:.0f} MB/s)")
+    return 0
+
+
+def revisit(rng: random.Random, dump: bytes) -> bytes:
+    """`dump` after another ride: new balance, ride count and last ride sectors."""
+    visit = bytearray(dump)
+    for sector in (4, 9, 12):
+        start = addr(sector, 0, 0)
+        visit[start:start + 16] = bytes(rng.getrandbits(8) for _ in range(16))
+    return bytes(visit)
+
+
+def bench_store(args):
+    from formats import load_file
+    from sectorstore import SectorStore
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        flat = os.path.join(tmp, "flat")
+        os.mkdir(flat)
+        paths = []
+        for card in range(args.cards):
+            dump = make_dump(rng, args.size)
+            for visit in range(args.visits):
+                dump = revisit(rng, dump)
+                paths.append(os.path.join(flat, f"{card:05d}_{visit:03d}.bin"))
+                with open(paths[-1], "wb") as dump_file:
+                    dump_file.write(dump)
+        on_disk = sum(os.stat(path).st_blocks * 512 for path in paths)
+
+        with SectorStore(os.path.join(tmp, "store")) as store:
+            _, elapsed = timed(lambda: [store.put(path, load_file(path)) for path in paths])
+            store.flush()
+            stats = store.stats()
+            print(f"{len(paths)} dumps of {args.size} bytes, {args.cards} cards: "
+                  f"{stats['dump_bytes'] / 1e6:.1f} MB of dumps, "
+                  f"{on_disk / 1e6:.1f} MB as files on disk, "
+                  f"{stats['stored_bytes'] / 1e6:.2f} MB stored "
+                  f"({stats['ratio']:g}x, {stats['sectors']} distinct sectors), "
+                  f"stored at {len(paths) / elapsed:.0f} dumps/s")
+            assert all(store.get_bytes(path) == bytes(load_file(path)) for path in paths)
+
+            files, files_elapsed = timed(
+                lambda: [Card.from_file(path).to_dict() for path in paths])
+            stored, stored_elapsed = timed(
+                lambda: [Card(dump).to_dict() for name, dump in store.items()])
+            assert stored == files
+            print(f"read and decode all: files {len(paths) / files_elapsed:.0f} dumps/s, "
+                  f"store {len(paths) / stored_elapsed:.0f} dumps/s")
+    return 0
+
+
+# The headless core, none of them may pull in the GUI or the reader stack
+CORE_MODULES = ("layout", "formats", "validate", "card", "batch")
+HEAVY_MODULES = ("PyQt5", "design", "smartcard", "acr122ulib", "numpy", "sqlite3")
+
+
+def import_time(module: str):
+    """Cumulative import time of `module` in a fresh interpreter, in seconds,
+    and the heavy modules it imported.
+    """
+    code = (f"import sys, {module}; print(' '.join(sorted("
+            f"{{name.split('.')[0] for name in sys.modules}} & {set(HEAVY_MODULES)!r})))")
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)  # measure with cached bytecode
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env,
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True)
+    if process.returncode:
+        raise ImportError(process.stderr.strip().splitlines()[-1])
+    for line in process.stderr.splitlines():
+        self_time, cumulative, name = line.split("|")
+        if name.strip() == module and name.startswith(" " + module):
+            return int(cumulative) / 1e6, process.stdout.split()
+    raise RuntimeError(f"{module} is missing from the import times")
+
+
+def bench_imports(args):
+    failed = False
+    print(f"import time, best of {args.repeat}, budget {args.budget:g} ms")
+    for module in args.modules:
+        try:
+            results = [import_time(module) for _ in range(args.repeat)]
+        except ImportError as e:
+            print(f"{module:<10} {e}")
+            failed = True
+            continue
+        best = min(seconds for seconds, heavy in results)
+        heavy = results[0][1]
+        over = best * 1000 > args.budget
+        failed = failed or over or bool(heavy)
+        print(f"{module:<10} {best * 1000:>7.1f} ms"
+              + (" OVER BUDGET" if over else "")
+              + (f" imports {', '.join(heavy)}" if heavy else ""))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Plantain parser benchmarks")
+    parser.add_argument("--seed", type=int, default=0)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    columnar_parser = subparsers.add_parser(
+        "columnar", help="per-Card getters against the NumPy columnar decoder")
+    columnar_parser.add_argument("-n", "--count", type=int, default=100000)
+    columnar_parser.add_argument("--size", type=int, choices=[1024, 4096], default=1024)
+    columnar_parser.set_defaults(func=bench_columnar)
+
+    reader_parser = subparsers.add_parser(
+        "reader", help="card dumps on the simulated ACR122U for several dictionary sizes")
+    reader_parser.add_argument("-k", "--keys", type=int, nargs="+", default=[10, 100, 1000],
+                               help="key dictionary sizes")
+    reader_parser.add_argument("--distinct", type=int, default=4,
+                               help="distinct keys used by the card's sectors")
+    reader_parser.add_argument("--latency", type=float, default=0.0,
+                               help="simulated delay of every APDU, ms")
+    reader_parser.add_argument("--size", type=int, choices=[1024, 4096], default=1024)
+    reader_parser.set_defaults(func=bench_reader)
+
+    formats_parser = subparsers.add_parser(
+        "formats", help="loading .bin, .eml and proxmark3 JSON dumps")
+    formats_parser.add_argument("-n", "--count", type=int, default=2000)
+    formats_parser.add_argument("--large", type=int, default=20000,
+                                help="dumps in the large file of every format")
+    formats_parser.add_argument("--size", type=int, choices=[1024, 4096], default=1024)
+    formats_parser.set_defaults(func=bench_formats)
+
+    store_parser = subparsers.add_parser(
+        "store", help="sector-deduplicating storage of repeated dumps against plain files")
+    store_parser.add_argument("-c", "--cards", type=int, default=200)
+    store_parser.add_argument("-v", "--visits", type=int, default=50,
+                              help="dumps of every card")
+    store_parser.add_argument("--size", type=int, choices=[1024, 4096], default=1024)
+    store_parser.set_defaults(func=bench_store)
+
+    imports_parser = subparsers.add_parser(
+        "imports", help="cold import time of the headless core, fails over budget")
+    imports_parser.add_argument("modules", nargs="*", default=CORE_MODULES)
+    imports_parser.add_argument("--budget", type=float, default=25.0, metavar="MS",
+                                help="maximum import time of every module")
+    imports_parser.add_argument("-r", "--repeat", type=int, default=5)
+    imports_parser.set_defaults(func=bench_imports)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
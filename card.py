@@ -0,0 +1,224 @@
+from functools import lru_cache
+
+from formats import load_file
+from layout import PLANTAIN, Decoder, SparseDump, addr, convert
+from validate import validate
+
+
+def card_number(uid) -> str:
+
+    def calc_num(b_array_uid: list):
+        j = 0
+        for i, c in enumerate(b_array_uid):
+            j += (c & 255) << (i << 3)
+        return j
+
+    def calc_verity(num: str):
+        num += "0"
+        lenght = len(num)
+        i = (lenght - 1) % 2
+        i2 = 0
+        for count, num_i in enumerate(num):
+            num_i = int(num_i)
+            if i == (lenght - count - 1) % 2:
+                num_i *= 2
+            i2 = num_i % 10 + num_i//10 + i2
+        return 10 - (i2 % 10)
+
+    num = str("96433078") + str(calc_num(uid))
+    num += str(calc_verity(num))
+
+    return num
+
+
+def passport(serial, number: int):
+    try:
+        serial = str(serial, "utf-8").replace(" ", "")
+        return int(serial+str(number))
+    except:
+        return None
+
+
+# Bump when the getters or to_dict() records change, invalidates ParseCache
+RECORD_VERSION = 2
+
+# Layout fields each record field is computed from
+RECORD_FIELDS = {
+    "card_type": ("lastname", "firstname_and_patronymic", "ekp_num"),
+    "balance": ("balance",),
+    "number": ("uid",),
+    "ekp_num": ("ekp_num",),
+    "name": ("lastname", "firstname_and_patronymic"),
+    "passport": ("lastname", "firstname_and_patronymic",
+                 "passport_serial", "passport_number"),
+    "last_day": ("lastname", "firstname_and_patronymic", "last_day"),
+}
+
+
+def available_fields(sectors, sector_count=40) -> tuple:
+    """Record fields that can be decoded from `sectors` of a partial dump.
+
+    Sectors the card doesn't have (past `sector_count`) count as available.
+    """
+    return tuple(field for field, names in RECORD_FIELDS.items()
+                 if all(PLANTAIN[name].sector in sectors or PLANTAIN[name].sector >= sector_count
+                        for name in names))
+
+
+class RecordDecoder:
+    """Builds Card.to_dict() records straight from a dump buffer.
+
+    Only the layout fields needed for the selected record fields are
+    decoded, e.g. a balance-only decoder never touches the cp1251 names.
+    """
+
+    def __init__(self, fields=None):
+        self.fields = tuple(RECORD_FIELDS if fields is None else fields)
+        needed = []
+        for field in self.fields:
+            for name in RECORD_FIELDS[field]:
+                if name not in needed:
+                    needed.append(name)
+        self._decoder = Decoder(needed)
+
+    def decode(self, buffer, offset=0) -> dict:
+        values = self._decoder.decode(buffer, offset)
+        record = {}
+        benefit = False
+        if "lastname" in values:
+            full_name = values["lastname"] + " " + values["firstname_and_patronymic"]
+            benefit = full_name != " "
+        for field in self.fields:
+            if field == "card_type":
+                card_type = "Льготный проездной" if benefit else "Подорожник"
+                if values["ekp_num"]:
+                    card_type = "Единая карта Петербуржца + " + card_type
+                record[field] = card_type
+            elif field == "balance":
+                record[field] = values["balance"]//100
+            elif field == "number":
+                record[field] = card_number(values["uid"])
+            elif field == "ekp_num":
+                record[field] = values["ekp_num"] or None
+            elif field == "name":
+                record[field] = full_name.strip() or None
+            elif field == "passport":
+                record[field] = passport(values["passport_serial"],
+                                         values["passport_number"]) if benefit else None
+            elif field == "last_day":
+                record[field] = values["last_day"] if benefit else None
+        return record
+
+
+@lru_cache(maxsize=None)
+def record_decoder(fields=None) -> RecordDecoder:
+    return RecordDecoder(fields)
+
+
+class Card:
+    def __init__(self, dump, uid=None, offset=0, size=None):
+        # Any buffer works (bytes, bytearray, mmap, memoryview); getters
+        # return slices of this view instead of copies. A SparseDump holds
+        # only the sectors that were read.
+        if isinstance(dump, SparseDump):
+            self._dump = dump
+        else:
+            self._dump = memoryview(dump)
+        if (offset or size is not None) and not isinstance(dump, SparseDump):
+            end = offset + size if size is not None else None
+            self._dump = self._dump[offset:end]
+        if uid:
+            self._uid = uid.encode()
+        else:
+            self._uid = None
+
+    @classmethod
+    def from_file(cls, path: str, offset=0, size=None):
+        # .bin/.mfd, .eml or proxmark3 JSON, see formats.load_file
+        return cls(load_file(path), offset=offset, size=size)
+
+    @property
+    def dump(self):
+        return self._dump
+
+    @property
+    def uid(self):
+        return self._uid
+
+    def validate(self):
+        """Why the dump isn't a valid Plantain dump (see validate.REASONS), None if it is."""
+        return validate(self.dump)
+
+    def verify_dump(self):
+        return self.validate() is None
+
+    def get_uid(self):
+        if self.uid == None:
+            return self.read_field("uid")
+        else:
+            return self.uid
+
+    def _get_addr(self, sec: int, blk: int, offset: int):
+        return addr(sec, blk, offset)
+
+    def get_data(self, sec: int, blk: int, start: int, end: int):
+        if isinstance(self.dump, SparseDump):
+            return self.dump.data(sec, blk, start, end)
+        return self.dump[self._get_addr(sec, blk, start):self._get_addr(sec, blk, end)]
+
+    def read_field(self, name: str):
+        field = PLANTAIN[name]
+        return convert(field, self.get_data(field.sector, field.block, field.start, field.end))
+
+    def get_number(self):
+        return card_number(self.get_uid())
+
+    def get_balance(self):
+        return self.read_field("balance")//100
+
+    def get_ekp_num(self):
+        return self.read_field("ekp_num")
+
+    def get_last_day(self):
+        return self.read_field("last_day")
+
+    def get_passport(self):
+        return passport(self.read_field("passport_serial"), self.read_field("passport_number"))
+
+    def get_lastname(self):
+        return self.read_field("lastname")
+
+    def get_firstname_and_patronymic(self):
+        return self.read_field("firstname_and_patronymic")
+
+    def get_underground_rides(self):
+        return str(self.read_field("underground_rides"))
+
+    def get_last_land_ride(self):  # 12 sec, 0 blk, 9-15 bytes
+        print(bytes(self.get_data(12, 0, 0, 32)))
+        pass  # TODO
+
+    def get_last_underground_ride(self):  # 9 sec, 2 blk, 0-3 bytes
+        print(bytes(self.get_data(9, 2, 0, 3)))
+
+    def get_last_ride_time(self):  # 5 sec, 0 blk, 0-3 bytes
+        pass  # TODO
+
+    def get_last_count(self):  # 5 sec, 0 blk, 6-8 bytes
+        pass  # TODO
+
+    def get_last_balance_top_up(self):  # 4 sec, 2 blk, 8-11 bytes
+        pass  # TODO
+
+    def get_last_balance_top_up_date(self):  # 4 sec, 2 blk, 2-5 bytes
+        pass  # TODO
+
+    def get_activation_time(self):  # 5 sec, 0 blk, 0-3 bytes
+        pass  # TODO
+
+    def get_full_name(self):
+        return self.get_lastname() + " " + self.get_firstname_and_patronymic()
+
+    def to_dict(self, fields=None) -> dict:
+        # The number always comes from block 0, as for dumps read from files
+        return record_decoder(None if fields is None else tuple(fields)).decode(self.dump)
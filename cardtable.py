@@ -0,0 +1,280 @@
+import os
+
+from PyQt5 import QtCore, QtWidgets
+from PyQt5.QtCore import Qt
+
+from batch import parse_file
+from workers import DecodeThread, DirectoryThread
+
+COLUMNS = ("path", "created", "card_type", "balance", "number", "ekp_num", "name",
+           "passport", "last_day", "error")
+HEADERS = ("Файл", "Дата создания", "Тип карты", "Баланс", "Номер карты", "Номер EKП",
+           "ФИО", "Паспорт", "Дата окончания действия", "Ошибка")
+
+
+def _sort_key(value):
+    # Numbers and text each compared among themselves
+    return isinstance(value, str), value
+
+
+class CardTableModel(QtCore.QAbstractTableModel):
+    """The dumps of a directory, one row each, for a QTableView.
+
+    Rows hold just their path until the view paints them, then they're
+    decoded one at a time; the view gets rows a page at a time through
+    fetchMore() as it scrolls. Sorting and filtering need every row, so
+    they first decode the rest in a DecodeThread and apply once it's done.
+    Records are kept as COLUMNS tuples, not dicts, to stay small with
+    100k rows.
+    """
+
+    PAGE = 1000
+    status = QtCore.pyqtSignal(str)
+
+    def __init__(self, cache_path: str = None, parent=None):
+        super().__init__(parent)
+        self.cache_path = cache_path
+        self._paths = []
+        self._records = []  # COLUMNS tuple per path, None until decoded
+        self._decoded = 0
+        self._order = []  # indices into _paths of the rows shown, filtered and sorted
+        self._shown = 0  # rows of _order the view has fetched
+        self._sort = None  # (column, Qt.SortOrder)
+        self._filter = None  # (column or None for any, lowercase text)
+        self._texts = []  # lowercase text of every column per decoded row, for filtering
+        self._lister = None
+        self._decoder = None
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else self._shown
+
+    def columnCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            value = self.record(self._order[index.row()])[index.column()]
+            if value is None:
+                return ""
+            return os.path.basename(value) if index.column() == 0 else str(value)
+        if role == Qt.ToolTipRole and index.column() == 0:
+            return self._paths[self._order[index.row()]]
+        return None
+
+    def canFetchMore(self, parent) -> bool:
+        return not parent.isValid() and self._shown < len(self._order)
+
+    def fetchMore(self, parent):
+        count = min(self.PAGE, len(self._order) - self._shown)
+        if parent.isValid() or count <= 0:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self._shown, self._shown + count - 1)
+        self._shown += count
+        self.endInsertRows()
+
+    def sort(self, column: int, order=Qt.AscendingOrder):
+        # -1 is Qt's "unsorted", the order the files were listed in
+        self._sort = (column, order) if column >= 0 else None
+        self._apply()
+
+    def set_filter(self, text: str, column: int = None):
+        """Shows only rows with `text` in `column` (any column if None),
+        case-insensitively.
+        """
+        self._filter = (column, text.lower()) if text else None
+        self._apply()
+
+    def path(self, row: int) -> str:
+        return self._paths[self._order[row]]
+
+    def record(self, index: int) -> tuple:
+        record = self._records[index]
+        if record is None:
+            record = self._store(index, parse_file(self._paths[index]))
+        return record
+
+    def _store(self, index: int, record: dict) -> tuple:
+        values = self._records[index] = tuple(record[name] for name in COLUMNS)
+        self._decoded += 1
+        return values
+
+    def load(self, directory: str):
+        """Replaces the rows with the dumps under `directory`, listed in the background."""
+        self.stop()
+        self.beginResetModel()
+        self._paths, self._records, self._order, self._texts = [], [], [], []
+        self._decoded = self._shown = 0
+        self.endResetModel()
+        self._lister = DirectoryThread(directory, parent=self)
+        self._lister.found.connect(self._add_paths)
+        self._lister.finished.connect(self._listed)
+        self._lister.start()
+
+    def stop(self):
+        for thread in (self._lister, self._decoder):
+            if thread is not None:
+                thread.cancel()
+                thread.wait()
+                thread.deleteLater()
+        self._lister = self._decoder = None
+
+    def _add_paths(self, paths: list):
+        if self.sender() is not self._lister:
+            return  # queued before load() replaced the directory
+        start = len(self._paths)
+        self._paths += paths
+        self._records += [None] * len(paths)
+        if self._sort is None and self._filter is None:
+            self._order += range(start, len(self._paths))
+            if self._shown < self.PAGE:
+                self.fetchMore(QtCore.QModelIndex())
+            self.status.emit(f"Найдено дампов: {len(self._paths)}")
+        else:
+            self._apply()
+
+    def _listed(self):
+        if self.sender() is not self._lister:
+            return
+        self._lister.deleteLater()
+        self._lister = None
+        if self._decoder is None:
+            self._report()
+
+    def _apply(self):
+        if self._sort is None and self._filter is None:
+            order = list(range(len(self._paths)))
+        elif self._decoded < len(self._paths):
+            self._decode_rest()
+            return
+        else:
+            order = self._filtered()
+            if self._sort is not None:
+                column, sort_order = self._sort
+                records = self._records
+                # Empty cells stay last in either order
+                empty = [index for index in order if records[index][column] is None]
+                order = [index for index in order if records[index][column] is not None]
+                order.sort(key=lambda index: _sort_key(records[index][column]),
+                           reverse=sort_order == Qt.DescendingOrder)
+                order += empty
+        self.beginResetModel()
+        self._order = order
+        self._shown = min(len(order), max(self._shown, self.PAGE))
+        self.endResetModel()
+        self._report()
+
+    def _filtered(self) -> list:
+        if self._filter is None:
+            return list(range(len(self._paths)))
+        column, text = self._filter
+        records = self._records
+        if column is None:
+            # Built once, later filters over any column only search strings
+            self._texts += ["\0".join(str(value) for value in record if value is not None).lower()
+                            for record in records[len(self._texts):]]
+            return [index for index, row_text in enumerate(self._texts) if text in row_text]
+        return [index for index, record in enumerate(records)
+                if record[column] is not None and text in str(record[column]).lower()]
+
+    def _decode_rest(self):
+        if self._decoder is not None:
+            return  # _decoded_all() applies again and picks up rows added since
+        rows = [(index, self._paths[index])
+                for index, record in enumerate(self._records) if record is None]
+        self._decoder = DecodeThread(rows, self.cache_path, parent=self)
+        self._decoder.decoded.connect(self._decoded_chunk)
+        self._decoder.finished.connect(self._decoded_all)
+        self._decoder.start()
+
+    def _decoded_chunk(self, chunk: list):
+        if self.sender() is not self._decoder:
+            return
+        for index, record in chunk:
+            if self._records[index] is None:
+                self._store(index, record)
+        self.status.emit(f"Разобрано дампов: {self._decoded} из {len(self._paths)}")
+
+    def _decoded_all(self):
+        if self.sender() is not self._decoder:
+            return
+        self._decoder.deleteLater()
+        self._decoder = None
+        self._apply()
+
+    def _report(self):
+        loading = " (загрузка…)" if self._lister is not None else ""
+        self.status.emit(f"Показано дампов: {len(self._order)} из {len(self._paths)}{loading}")
+
+
+class CardTableWindow(QtWidgets.QWidget):
+    """Every dump of a directory in one table, to browse many cards at once.
+
+    Double clicking a row emits `opened` with the dump's path.
+    """
+
+    opened = QtCore.pyqtSignal(str)
+
+    def __init__(self, cache_path: str = None, parent=None):
+        super().__init__(parent, Qt.Window)
+        self.setWindowTitle("Дампы")
+        self.resize(1100, 600)
+        self.model = CardTableModel(cache_path, self)
+
+        self.filter_edit = QtWidgets.QLineEdit(self)
+        self.filter_edit.setPlaceholderText("Фильтр")
+        self.filter_edit.setClearButtonEnabled(True)
+        self.filter_column = QtWidgets.QComboBox(self)
+        self.filter_column.addItem("Все столбцы")
+        self.filter_column.addItems(HEADERS)
+        self.status_label = QtWidgets.QLabel(self)
+
+        self.table = QtWidgets.QTableView(self)
+        self.table.setModel(self.model)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.table.setWordWrap(False)
+        # No sort column until a header is clicked, sorting decodes every dump
+        self.table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.table.setSortingEnabled(True)
+        # Fixed row heights, so the view never measures rows it doesn't paint
+        rows = self.table.verticalHeader()
+        rows.setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        rows.setDefaultSectionSize(self.fontMetrics().height() + 6)
+
+        filter_layout = QtWidgets.QHBoxLayout()
+        filter_layout.addWidget(self.filter_edit)
+        filter_layout.addWidget(self.filter_column)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(filter_layout)
+        layout.addWidget(self.table)
+        layout.addWidget(self.status_label)
+
+        # Filtering 100k rows takes a moment, so not on every keystroke
+        self.filter_timer = QtCore.QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(300)
+        self.filter_timer.timeout.connect(self.apply_filter)
+        self.filter_edit.textChanged.connect(lambda text: self.filter_timer.start())
+        self.filter_column.currentIndexChanged.connect(lambda column: self.filter_timer.start())
+        self.model.status.connect(self.status_label.setText)
+        self.table.doubleClicked.connect(
+            lambda index: self.opened.emit(self.model.path(index.row())))
+
+    def load(self, directory: str) -> None:
+        self.setWindowTitle(f"Дампы: {directory}")
+        self.model.load(directory)
+
+    def apply_filter(self) -> None:
+        column = self.filter_column.currentIndex() - 1
+        self.model.set_filter(self.filter_edit.text(), column if column >= 0 else None)
+
+    def closeEvent(self, event) -> None:
+        self.model.stop()
+        super().closeEvent(event)
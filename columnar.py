@@ -0,0 +1,91 @@
+import numpy as np
+
+from layout import PLANTAIN, addr
+
+
+# Digits of the constant card number prefix "96433078", see card_number()
+_PREFIX = "96433078"
+
+
+def stack_dumps(dumps, size=1024) -> np.ndarray:
+    """Copies dumps into an (N, size) uint8 array, short dumps are zero padded."""
+    dumps = list(dumps)
+    array = np.zeros((len(dumps), size), dtype=np.uint8)
+    for row, dump in zip(array, dumps):
+        data = np.frombuffer(dump, dtype=np.uint8)[:size]
+        row[:len(data)] = data
+    return array
+
+
+def load_archive(path: str, size=1024) -> np.ndarray:
+    """Maps a concatenated dump archive as an (N, size) array without reading it."""
+    archive = np.memmap(path, dtype=np.uint8, mode="r")
+    count = len(archive) // size
+    return archive[:count * size].reshape(count, size)
+
+
+def _columns(field):
+    start = addr(field.sector, field.block, field.start)
+    end = addr(field.sector, field.block, field.end)
+    return start, end
+
+
+def _le(array: np.ndarray, field) -> np.ndarray:
+    start, end = _columns(field)
+    value = np.zeros(len(array), dtype=np.uint64)
+    for i, column in enumerate(range(start, end)):
+        value |= array[:, column].astype(np.uint64) << np.uint64(8 * i)
+    return value
+
+
+def _check_digits(card_num: np.ndarray) -> np.ndarray:
+    # Same sum as calc_verity in card_number(): digits at even positions
+    # counted from the left of "96433078" + str(num) are doubled
+    def digit_sum(digit):
+        return digit % 10 + digit // 10
+
+    total = sum(digit_sum(int(d) * 2) if i % 2 == 0 else int(d)
+                for i, d in enumerate(_PREFIX))
+    total = np.full(len(card_num), total, dtype=np.int64)
+
+    digits = np.ones(len(card_num), dtype=np.int64)
+    rest = card_num // np.uint64(10)
+    while rest.any():
+        digits += rest > 0
+        rest //= np.uint64(10)
+
+    rest = card_num.copy()
+    position = digits - 1  # position of the current digit from the left of str(num)
+    while (position >= 0).any():
+        digit = (rest % np.uint64(10)).astype(np.int64)
+        doubled = (len(_PREFIX) + position) % 2 == 0
+        value = np.where(doubled, digit_sum(digit * 2), digit)
+        total += np.where(position >= 0, value, 0)
+        rest //= np.uint64(10)
+        position -= 1
+    return 10 - total % 10
+
+
+def decode_columns(array: np.ndarray) -> dict:
+    """Decodes the numeric fields of N stacked dumps into columns.
+
+    `array` is (N, 1024) or (N, 4096) uint8, e.g. from stack_dumps() or
+    load_archive(). The card number is "96433078" + str(card_num) +
+    str(check_digit), exactly as Card.get_number() builds it.
+    """
+    card_num = _le(array, PLANTAIN["uid"])
+    start, _ = _columns(PLANTAIN["last_day"])
+    return {
+        "balance": (_le(array, PLANTAIN["balance"]) // np.uint64(100)).astype(np.int64),
+        "underground_rides": _le(array, PLANTAIN["underground_rides"]).astype(np.int64),
+        "last_day_day": array[:, start + 2].astype(np.int64) - 1,
+        "last_day_month": array[:, start + 1].astype(np.int64),
+        "last_day_year": array[:, start].astype(np.int64) + 2000,
+        "card_num": card_num,
+        "check_digit": _check_digits(card_num),
+    }
+
+
+def format_numbers(columns: dict) -> list:
+    return [f"{_PREFIX}{num}{check}"
+            for num, check in zip(columns["card_num"].tolist(), columns["check_digit"].tolist())]
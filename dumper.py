@@ -0,0 +1,401 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+from collections import namedtuple
+from datetime import datetime
+from time import monotonic
+
+from smartcard.Exceptions import NoCardException, CardConnectionException
+
+from acr122ulib import (PresenceMonitor, ReaderSession, SectorResult, describe_key,
+                        dictionary_attack, enable_stats, search_readers)
+from card import RECORD_FIELDS, Card, available_fields
+from dumpstore import DumpStore
+from keystore import KeyStore
+from layout import PLANTAIN, SECTOR_COUNT, SparseDump
+
+
+class DumpResult(namedtuple("DumpResult", ["reader", "uid", "info", "sectors", "error"])):
+    """Outcome of one card dump, `sectors` maps sector numbers to SectorResult."""
+
+    @property
+    def sparse(self) -> SparseDump:
+        return SparseDump({sector: result.data for sector, result in self.sectors.items()})
+
+    @property
+    def dump(self) -> bytes:
+        return self.sparse.to_bytes()
+
+
+class LiveDump(SparseDump):
+    """A SparseDump backed by the card on the reader.
+
+    A sector is authenticated and read the first time something needs it
+    and then cached, sectors no key opens aren't retried.
+    """
+
+    def __init__(self, session: ReaderSession, key_store: KeyStore, sector_count=16,
+                 cancel=None):
+        super().__init__()
+        self.session = session
+        self.key_store = key_store
+        self.sector_count = sector_count
+        self.cancel = cancel  # for the reads getters trigger, see LiveCard
+        self.results = {}  # sector -> SectorResult
+        self.failed = set()
+
+    def load(self, sectors, progress=None, cancel=None, on_found=None):
+        if cancel is None:
+            cancel = self.cancel
+        missing = [sector for sector in sectors
+                   if sector < self.sector_count
+                   and sector not in self.sectors and sector not in self.failed]
+        if not missing:
+            return
+
+        def store(sector, result):
+            self.key_store.record(sector, result.key, result.key_type)
+            self.results[sector] = result
+            self.sectors[sector] = result.data
+            if on_found:
+                on_found(sector, result)
+
+        found = dictionary_attack(self.session, self.key_store.ordered_keys(), missing,
+                                  known=self.key_store.candidates(missing),
+                                  progress=progress, cancel=cancel, on_found=store)
+        if found:
+            self.key_store.save()
+        if not (cancel and cancel.is_set()):
+            self.failed.update(sector for sector in missing if sector not in found)
+
+
+def sector_count(info: dict) -> int:
+    return SECTOR_COUNT[1024 if "1K" in info["Name"] else 4096]
+
+
+class LiveCard(Card):
+    """A Card whose getters read only the sectors they need from the reader.
+
+    Showing the balance costs sectors 0 and 4 instead of a full dump, and
+    dump_card(live=card.dump) or dump_progressive(live=card.dump) later
+    reuses whatever was already read. Setting `cancel` stops a read that
+    has to fall back to the key dictionary.
+    """
+
+    def __init__(self, session: ReaderSession, key_store: KeyStore, cancel=None):
+        self.info = session.getinfo()
+        super().__init__(LiveDump(session, key_store, sector_count(self.info), cancel))
+
+    def to_dict(self, fields=None) -> dict:
+        """Like Card.to_dict(), leaving out the fields of sectors no key opened."""
+        fields = tuple(RECORD_FIELDS if fields is None else fields)
+        self.dump.load(sorted({PLANTAIN[name].sector
+                               for field in fields for name in RECORD_FIELDS[field]}))
+        readable = available_fields(self.dump.sectors, self.dump.sector_count)
+        return super().to_dict([field for field in fields if field in readable])
+
+
+def dump_card(session: ReaderSession, key_store: KeyStore, sectors=None,
+              progress=None, cancel=None, live: LiveDump = None) -> DumpResult:
+    uid = session.getuid()
+    info = session.getinfo()
+    if "MIFARE" not in info["Name"]:
+        return DumpResult(str(session.reader), uid, info, {}, "Карта не MIFARE!")
+    if live is None:
+        live = LiveDump(session, key_store, sector_count(info))
+    if sectors is None:
+        sectors = range(live.sector_count)
+    live.load(sectors, progress, cancel)
+    found = {sector: live.results[sector] for sector in sectors if sector in live.results}
+    for sector in sectors:
+        if sector not in found:
+            return DumpResult(str(session.reader), uid, info, found, f"No key for sector {sector}!")
+    return DumpResult(str(session.reader), uid, info, found, None)
+
+
+# UID and balance first so the operator sees them at once, then what the
+# card type and benefit fields need, then everything else
+SECTOR_PRIORITY = (0, 4, 13, 14, 32, 8)
+
+
+class Deadline:
+    """Acts as the `cancel` event of dictionary_attack: set once `budget`
+    seconds have passed or `cancel` is set.
+    """
+
+    def __init__(self, budget=None, cancel=None):
+        self.expires = None if budget is None else monotonic() + budget
+        self.cancel = cancel
+
+    def is_set(self) -> bool:
+        if self.cancel and self.cancel.is_set():
+            return True
+        return self.expires is not None and monotonic() >= self.expires
+
+
+def dump_progressive(session: ReaderSession, key_store: KeyStore, budget=None,
+                     on_sector=None, progress=None, cancel=None,
+                     live: LiveDump = None) -> DumpResult:
+    """Reads sectors in SECTOR_PRIORITY order within `budget` seconds.
+
+    `on_sector(sector, card)` gets a Card of everything read so far after
+    every sector. Running out of time, cancelling or pulling the card away
+    still returns the sectors read by then, with `error` set.
+    """
+    deadline = Deadline(budget, cancel)
+    uid = session.getuid()
+    info = session.getinfo()
+    if "MIFARE" not in info["Name"]:
+        return DumpResult(str(session.reader), uid, info, {}, "Карта не MIFARE!")
+    if live is None:
+        live = LiveDump(session, key_store, sector_count(info))
+    sectors = range(live.sector_count)
+    first = [sector for sector in SECTOR_PRIORITY if sector < live.sector_count]
+    rest = [sector for sector in sectors if sector not in first]
+
+    def publish(sector, result):
+        if on_sector:
+            # A snapshot, so the consumer never triggers reads on the session
+            on_sector(sector, Card(SparseDump(live.sectors)))
+
+    # Every load() runs its own dictionary_attack counting from zero, progress
+    # is reported for the whole card instead
+    attempts = 0  # of the finished load() calls
+    load_attempts = 0
+
+    def report(opened, total, so_far):
+        nonlocal load_attempts
+        load_attempts = so_far
+        progress(len(live.results), live.sector_count, attempts + load_attempts)
+
+    def load(sectors):
+        nonlocal attempts, load_attempts
+        live.load(sectors, report if progress else None, deadline, publish)
+        attempts += load_attempts
+        load_attempts = 0
+
+    error = None
+    try:
+        for sector in first:
+            if deadline.is_set():
+                break
+            load((sector,))
+        if not deadline.is_set():
+            load(rest)
+    except (NoCardException, CardConnectionException):
+        error = "Карта убрана с ридера!"
+    found = {sector: live.results[sector] for sector in sectors if sector in live.results}
+    if error is None and len(found) < len(sectors):
+        if deadline.is_set():
+            error = f"Прочитано {len(found)} из {len(sectors)} секторов"
+        else:
+            missing = [sector for sector in sectors if sector not in found]
+            error = f"No key for sector {missing[0]}!"
+    return DumpResult(str(session.reader), uid, info, found, error)
+
+
+# Sectors that change between visits: balance and top ups, last ride,
+# underground and land ride history. Everything else is written once.
+VOLATILE_SECTORS = (4, 5, 9, 12)
+# Re-read on a known card to make sure its static sectors are still valid;
+# it holds the benefit's last day, so a renewal forces a full dump
+SENTINEL_SECTOR = 8
+
+
+def dump_differential(session: ReaderSession, key_store: KeyStore, store: DumpStore,
+                      progress=None, cancel=None) -> DumpResult:
+    """Re-reads only VOLATILE_SECTORS of a card already in `store`.
+
+    The other sectors come from the stored dump if SENTINEL_SECTOR still
+    matches it, otherwise (and for unknown cards) the card is dumped in
+    full. Complete dumps are saved back to `store`.
+    """
+    uid = session.getuid()
+    info = session.getinfo()
+    if "MIFARE" not in info["Name"]:
+        return DumpResult(str(session.reader), uid, info, {}, "Карта не MIFARE!")
+    live = LiveDump(session, key_store, sector_count(info))
+    previous = store.get(uid) if uid else None
+    result = None
+    if previous is not None:
+        stored = SparseDump.from_buffer(previous)
+        live.load((SENTINEL_SECTOR,), progress, cancel)
+        if (len(stored.sectors) == live.sector_count
+                and live.sectors.get(SENTINEL_SECTOR) == stored.sectors[SENTINEL_SECTOR]):
+            live.load([sector for sector in VOLATILE_SECTORS if sector < live.sector_count],
+                      progress, cancel)
+            # Stored sectors weren't read, the key store knows which key opens them
+            known = key_store.known(stored.sectors)
+            found = {sector: live.results.get(sector)
+                     or SectorResult(*known.get(sector, (None, None)), bytes(data))
+                     for sector, data in stored.sectors.items()}
+            result = DumpResult(str(session.reader), uid, info, found, None)
+            for sector in VOLATILE_SECTORS:
+                if sector < live.sector_count and sector not in live.results:
+                    result = result._replace(error=f"No key for sector {sector}!")
+    if result is None:
+        result = dump_card(session, key_store, progress=progress, cancel=cancel, live=live)
+    if not result.error and uid:
+        store.put(uid, result.dump)
+    return result
+
+
+class DumpWorker(threading.Thread):
+    """Dumps every card tapped on one reader, over the worker's own connection.
+
+    Errors are reported as DumpResult with `error` set and never leave the
+    thread, so an unplugged reader doesn't affect the other workers.
+    """
+
+    def __init__(self, reader, key_store: KeyStore, results: queue.Queue,
+                 stop_event: threading.Event, sectors=None, interval=0.5, budget=None,
+                 store: DumpStore = None):
+        super().__init__(name=f"DumpWorker {reader}", daemon=True)
+        self.reader = reader
+        self.key_store = key_store
+        self.results = results
+        self.stop_event = stop_event
+        self.sectors = sectors
+        self.interval = interval
+        self.budget = budget
+        self.store = store
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                with PresenceMonitor(self.reader) as monitor:
+                    self.watch(monitor)
+            except Exception as e:
+                self.results.put(DumpResult(str(self.reader), None, None, {}, str(e)))
+                self.stop_event.wait(self.interval * 10)
+
+    def watch(self, monitor: PresenceMonitor):
+        # Sleeps in PC/SC until a card is tapped, `interval` only bounds how
+        # long a stop request may go unnoticed
+        while not self.stop_event.is_set():
+            if not monitor.wait(present=True, timeout=self.interval):
+                continue
+            with ReaderSession(self.reader) as session:
+                connected = session.connect(attempts=1, interval=0)
+                if connected == False:
+                    self.results.put(DumpResult(str(self.reader), None, None, {},
+                                                "Ошибка соединения!"))
+                elif connected:
+                    try:
+                        if self.store is not None:
+                            result = dump_differential(session, self.key_store, self.store,
+                                                       cancel=self.stop_event)
+                        elif self.budget is not None:
+                            result = dump_progressive(session, self.key_store, self.budget,
+                                                      cancel=self.stop_event)
+                        else:
+                            result = dump_card(session, self.key_store, self.sectors,
+                                               cancel=self.stop_event)
+                    except (NoCardException, CardConnectionException):
+                        result = DumpResult(str(self.reader), None, None, {},
+                                            "Карта убрана с ридера!")
+                    if self.stop_event.is_set():
+                        return
+                    self.results.put(result)
+            while not self.stop_event.is_set():
+                if monitor.wait(present=False, timeout=self.interval):
+                    break
+
+
+class DumpEngine:
+    """Runs a DumpWorker per attached reader, results go to one shared queue."""
+
+    def __init__(self, key_store: KeyStore, readers=None, sectors=None, interval=0.5,
+                 budget=None, store: DumpStore = None):
+        self.key_store = key_store
+        self.budget = budget
+        self.store = store
+        self.readers = search_readers() if readers is None else readers
+        self.sectors = sectors
+        self.interval = interval
+        self.results = queue.Queue()
+        self.stop_event = threading.Event()
+        self.workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.stop_event.clear()
+        self.workers = [DumpWorker(reader, self.key_store, self.results, self.stop_event,
+                                   self.sectors, self.interval, self.budget, self.store)
+                        for reader in self.readers]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def __iter__(self):
+        while not self.stop_event.is_set():
+            try:
+                yield self.results.get(timeout=self.interval)
+            except queue.Empty:
+                pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Dump every card put on any attached ACR122U reader")
+    parser.add_argument("-o", "--output", default=".", help="directory for the dumps")
+    parser.add_argument("--keys", default="keys.txt")
+    parser.add_argument("--stats", default="keystats.json")
+    parser.add_argument("--budget", type=float, metavar="SECONDS",
+                        help="read sectors by priority and stop after SECONDS")
+    parser.add_argument("--store", metavar="DIR",
+                        help="keep the last dump of every card in DIR and re-read "
+                        "only the changing sectors of known cards")
+    parser.add_argument("--parse", action="store_true",
+                        help="print the parsed card record of every dump as JSON")
+    parser.add_argument("--apdu-stats", metavar="FILE",
+                        help="time every APDU and write a JSON summary to FILE on exit")
+    args = parser.parse_args(argv)
+
+    readers = search_readers()
+    if not readers:
+        print("Не найдено ни одного ридера!", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    store = DumpStore(args.store) if args.store else None
+    stats = enable_stats() if args.apdu_stats else None
+    with DumpEngine(KeyStore(args.keys, args.stats), readers, budget=args.budget,
+                    store=store) as engine:
+        try:
+            for result in engine:
+                if result.error:
+                    print(f"{result.reader}: {result.error}", file=sys.stderr)
+                    continue
+                name = f"{result.uid}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.bin"
+                with open(os.path.join(args.output, name), "wb") as dump_file:
+                    dump_file.write(result.dump)
+                keys = ", ".join(f"{sector}:{describe_key(sector_result)}"
+                                 for sector, sector_result in sorted(result.sectors.items()))
+                print(f"{result.reader}: {name} ({keys})", file=sys.stderr)
+                if args.parse:
+                    record = Card(result.dump).to_dict()
+                    print(json.dumps(dict(record, uid=result.uid, dump=name),
+                                     ensure_ascii=False), flush=True)
+        except KeyboardInterrupt:
+            pass
+    if stats is not None:
+        with open(args.apdu_stats, "w") as stats_file:
+            stats_file.write(stats.to_json(indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import os
+
+
+class DumpStore:
+    """The latest full dump of every card seen, as one <uid>.bin file per card."""
+
+    def __init__(self, path="dumpstore"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, uid: str) -> str:
+        return os.path.join(self.path, uid.lower() + ".bin")
+
+    def __contains__(self, uid: str) -> bool:
+        return os.path.exists(self._file(uid))
+
+    def get(self, uid: str):
+        try:
+            with open(self._file(uid), "rb") as dump_file:
+                return dump_file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, uid: str, dump: bytes):
+        tmp_path = self._file(uid) + ".tmp"
+        with open(tmp_path, "wb") as dump_file:
+            dump_file.write(dump)
+        os.replace(tmp_path, self._file(uid))
@@ -0,0 +1,102 @@
+import mmap
+import os
+
+# Everything an .eml dump is made of; proxmark writes "--" for bytes it couldn't read
+_EML_BYTES = b"0123456789abcdefABCDEF-\r\n\t "
+_SNIFF_SIZE = 4096
+_CHUNK_SIZE = 1 << 20
+# Smaller files are read, mapping and unmapping costs more than copying a few pages
+_MAP_SIZE = 16 * 1024
+
+
+def _view(dump_file) -> memoryview:
+    size = os.fstat(dump_file.fileno()).st_size
+    if size < _MAP_SIZE:
+        dump_file.seek(0)
+        return memoryview(dump_file.read())
+    return memoryview(mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def map_file(path: str) -> memoryview:
+    """The content of `path` as a memoryview: mapped for large files such
+    as archives, read into memory for single dumps.
+    """
+    with open(path, "rb") as dump_file:
+        return _view(dump_file)
+
+
+def file_version(path: str):
+    """(size, mtime_ns) of `path`, None if it's gone."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def detect_format(head: bytes) -> str:
+    """"json", "eml" or "bin" judging by the first bytes of a dump file."""
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    # A binary dump may well start with "{", but is never all ASCII without zeros
+    if text.startswith(b"{") and text.isascii() and b"\x00" not in text:
+        return "json"
+    if b"\n" in head and not head.translate(None, _EML_BYTES):
+        return "eml"
+    return "bin"
+
+
+def decode_eml(text) -> bytes:
+    """Blocks of an .eml dump, a line of 32 hex digits each.
+
+    The whole text goes through one bytes.fromhex call, which skips the
+    line breaks itself, instead of one call per line.
+    """
+    return bytes.fromhex(bytes(text).replace(b"-", b"0").decode("ascii"))
+
+
+def read_eml(eml_file) -> bytearray:
+    """decode_eml() of a file object read in chunks, so a large .eml file
+    is never held as text in memory.
+    """
+    dump = bytearray()
+    rest = b""
+    while True:
+        chunk = eml_file.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        cut = chunk.rfind(b"\n") + 1
+        dump += decode_eml(chunk[:cut])
+        rest = chunk[cut:]
+    dump += decode_eml(rest)
+    return dump
+
+
+def decode_json(text) -> bytes:
+    """Blocks of a proxmark3 JSON dump, blocks it didn't read are zero filled."""
+    import json  # with re it doubles the import time of the core
+
+    blocks = json.loads(bytes(text))["blocks"]
+    numbers = [int(number) for number in blocks]
+    count = max(numbers) + 1 if numbers else 0
+    hex_blocks = ["00" * 16] * count
+    for number, block in zip(numbers, blocks.values()):
+        hex_blocks[number] = block
+    return decode_eml("".join(hex_blocks).encode("ascii"))
+
+
+def load_file(path: str):
+    """The dump in `path` as one buffer in the layout Card expects.
+
+    Binary dumps (.bin, .mfd) are read as they are, see map_file(), .eml and
+    proxmark3 JSON dumps are decoded; the format is detected from the
+    content, not the extension.
+    """
+    with open(path, "rb") as dump_file:
+        fmt = detect_format(dump_file.read(_SNIFF_SIZE))
+        dump_file.seek(0)
+        if fmt == "eml":
+            return read_eml(dump_file)
+        if fmt == "json":
+            return decode_json(dump_file.read())
+        return _view(dump_file)
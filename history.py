@@ -0,0 +1,200 @@
+import argparse
+import json
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+from batch import iter_dump_paths, map_chunks
+from card import RECORD_VERSION, Card
+from formats import file_version
+from sqlitedb import FileVersions, open_db
+
+# Bump when the table layout changes
+SCHEMA_VERSION = 2
+
+# One dump of a card; deltas are against the card's previous dump, None for its first
+Visit = namedtuple("Visit", ["mtime_ns", "path", "balance", "rides",
+                             "balance_delta", "rides_delta"])
+
+
+def _delta(value, previous):
+    if value is None or previous is None:
+        return None
+    return value - previous
+
+
+def history_chunk(paths: list) -> list:
+    """(path, version, number, balance, rides) of every path that still
+    exists; number, balance and rides are None if it isn't a valid dump.
+    """
+    entries = []
+    for path in paths:
+        version = file_version(path)
+        if version is None:
+            continue
+        number = balance = rides = None
+        try:
+            card = Card.from_file(path)
+            if not card.validate():
+                number, balance = card.get_number(), card.get_balance()
+                rides = int(card.get_underground_rides())
+        except Exception:
+            pass  # kept without a visit, so it isn't decoded again until it changes
+        entries.append((path, version, number, balance, rides))
+    return entries
+
+
+class CardHistory:
+    """Balance and ride count of every card across its dumps, in SQLite.
+
+    Visits are ordered by (card number, dump file mtime, file id), so adding
+    or removing a dump only reads its two neighbours and rewrites the
+    deltas of the one after it; nothing else of the card's history is
+    recomputed and nothing is held in memory. update() only decodes files
+    whose size or mtime changed since they were added.
+    """
+
+    SCHEMA = FileVersions.SCHEMA + (
+        "CREATE TABLE IF NOT EXISTS visits (number TEXT NOT NULL, mtime_ns INTEGER NOT NULL, "
+        "file INTEGER NOT NULL, balance INTEGER, rides INTEGER, balance_delta INTEGER, "
+        "rides_delta INTEGER, PRIMARY KEY (number, mtime_ns, file)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS visits_file ON visits (file)",
+    )
+
+    def __init__(self, path="history.sqlite"):
+        self.path = path
+        self.db = open_db(path, {"schema": SCHEMA_VERSION, "record": RECORD_VERSION},
+                          self.SCHEMA)
+        self.files = FileVersions(self.db)
+
+    def _neighbours(self, number: str, mtime_ns: int, file: int):
+        # (mtime_ns, file, balance, rides) of the visits right before and after
+        key = (number, mtime_ns, file)
+        previous = self.db.execute(
+            "SELECT mtime_ns, file, balance, rides FROM visits WHERE number = ? "
+            "AND (mtime_ns, file) < (?, ?) ORDER BY mtime_ns DESC, file DESC LIMIT 1",
+            key).fetchone()
+        following = self.db.execute(
+            "SELECT mtime_ns, file, balance, rides FROM visits WHERE number = ? "
+            "AND (mtime_ns, file) > (?, ?) ORDER BY mtime_ns, file LIMIT 1", key).fetchone()
+        return previous, following
+
+    def _relink(self, number: str, visit, previous):
+        # Deltas of `visit` against `previous`, both (mtime_ns, file, balance, rides)
+        if visit is None:
+            return
+        balance, rides = (None, None) if previous is None else previous[2:]
+        self.db.execute(
+            "UPDATE visits SET balance_delta = ?, rides_delta = ? "
+            "WHERE number = ? AND mtime_ns = ? AND file = ?",
+            (_delta(visit[2], balance), _delta(visit[3], rides), number, visit[0], visit[1]))
+
+    def _remove_visit(self, file: int):
+        row = self.db.execute("SELECT number, mtime_ns FROM visits WHERE file = ?",
+                              (file,)).fetchone()
+        if row is None:
+            return
+        number, mtime_ns = row
+        previous, following = self._neighbours(number, mtime_ns, file)
+        self.db.execute("DELETE FROM visits WHERE number = ? AND mtime_ns = ? AND file = ?",
+                        (number, mtime_ns, file))
+        self._relink(number, following, previous)
+
+    def add(self, entries):
+        """Stores history_chunk() entries in one transaction, replacing the
+        visits of paths added before.
+        """
+        with self.db as db:
+            for path, version, number, balance, rides in entries:
+                known = self.files.get(path)
+                if known is not None:
+                    self._remove_visit(known[0])
+                file = self.files.mark(path, version)
+                if number is None:
+                    continue
+                mtime_ns = version[1]
+                previous, following = self._neighbours(number, mtime_ns, file)
+                visit = (mtime_ns, file, balance, rides)
+                db.execute("INSERT INTO visits VALUES (?, ?, ?, ?, ?, NULL, NULL)",
+                           (number, mtime_ns, file, balance, rides))
+                self._relink(number, visit, previous)
+                self._relink(number, following, visit)
+
+    def update(self, paths, workers=None, chunksize=256) -> int:
+        """Adds the new and changed files among `paths`, decoded in
+        `workers` processes; returns how many were (re)added.
+        """
+        count = 0
+        for entries in map_chunks(history_chunk, self.files.stale(paths), workers, chunksize):
+            self.add(entries)
+            count += len(entries)
+        return count
+
+    def prune(self) -> int:
+        """Drops the files that no longer exist, returns how many."""
+        gone = self.files.missing()
+        with self.db:
+            for path in gone:
+                self._remove_visit(self.files.get(path)[0])
+                self.files.remove(path)
+        return len(gone)
+
+    def timeline(self, number: str):
+        """Visits of card `number`, oldest first."""
+        rows = self.db.execute(
+            "SELECT visits.mtime_ns, path, balance, rides, balance_delta, rides_delta "
+            "FROM visits JOIN files ON files.id = visits.file "
+            "WHERE number = ? ORDER BY visits.mtime_ns, file", (number,))
+        for row in rows:
+            yield Visit(*row)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def format_delta(delta) -> str:
+    return "" if delta is None else f"{delta:+d}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Balance and ride history of cards dumped many times")
+    parser.add_argument("--history", default="history.sqlite", help="history file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    update = commands.add_parser("update", help="add new and changed dumps")
+    update.add_argument("sources", nargs="+", help="dump files, directories or glob patterns")
+    update.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes, defaults to the number of CPUs")
+    update.add_argument("--prune", action="store_true",
+                        help="also drop dumps that were deleted")
+    show = commands.add_parser("show", help="print the timeline of a card")
+    show.add_argument("number", help="card number")
+    show.add_argument("--json", action="store_true", help="one JSON object per visit")
+    args = parser.parse_args(argv)
+
+    with CardHistory(args.history) as history:
+        if args.command == "update":
+            count = history.update(iter_dump_paths(args.sources), args.workers)
+            pruned = history.prune() if args.prune else 0
+            print(f"{count} dumps added, {pruned} pruned", file=sys.stderr)
+            return 0
+        found = False
+        for visit in history.timeline(args.number):
+            found = True
+            if args.json:
+                print(json.dumps(visit._asdict(), ensure_ascii=False))
+                continue
+            dumped = datetime.fromtimestamp(visit.mtime_ns / 1e9).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{dumped}\t{visit.balance}\t{format_delta(visit.balance_delta)}\t"
+                  f"{visit.rides}\t{format_delta(visit.rides_delta)}\t{visit.path}")
+        return 0 if found else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
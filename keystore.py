@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+from collections import Counter
+
+
+def normalize_key(line: str):
+    key = line.split("#", 1)[0].strip().lower()
+    if len(key) != 12:
+        return None
+    try:
+        int(key, 16)
+    except ValueError:
+        return None
+    return key
+
+
+class KeyStore:
+    """Key dictionary ordered by how often each key opened each sector.
+
+    Hit counts per (sector, key, key type) are persisted to `stats_path`.
+    The dictionary file itself is only read once the keys with hits run
+    out, so a large dictionary costs nothing when the known keys work.
+    """
+
+    def __init__(self, keys_path="keys.txt", stats_path="keystats.json"):
+        self.keys_path = keys_path
+        self.stats_path = stats_path
+        self._keys = None
+        self._lock = threading.Lock()  # shared by dump workers of several readers
+        self.hits = Counter()  # (sector, key, key type) -> hits
+        self.load_stats()
+
+    def _read_keys(self) -> dict:
+        # dict keeps file order and dedupes in O(1)
+        keys = {}
+        with open(self.keys_path, "r") as keyfile:
+            for line in keyfile:
+                key = normalize_key(line)
+                if key:
+                    keys[key] = None
+        return keys
+
+    @property
+    def keys(self) -> dict:
+        # Read once even if several workers run out of known keys at the same time
+        if self._keys is None:
+            with self._lock:
+                if self._keys is None:
+                    self._keys = self._read_keys()
+        return self._keys
+
+    def load_stats(self):
+        try:
+            with open(self.stats_path, "r") as stats_file:
+                for sector, key, key_type, hits in json.load(stats_file):
+                    self.hits[(sector, key, key_type)] = hits
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        with self._lock:
+            stats = [[sector, key, key_type, hits]
+                     for (sector, key, key_type), hits in self.hits.most_common()]
+            tmp_path = self.stats_path + ".tmp"
+            with open(tmp_path, "w") as stats_file:
+                json.dump(stats, stats_file)
+            os.replace(tmp_path, self.stats_path)
+
+    def record(self, sector: int, key: str, key_type: int):
+        with self._lock:
+            self.hits[(sector, key, key_type)] += 1
+
+    def _snapshot(self) -> list:
+        with self._lock:
+            return self.hits.most_common()
+
+    def candidates(self, sectors=range(16), limit=3) -> dict:
+        """(key, key type) pairs that opened each of `sectors` before, most
+        hits first, at most `limit` per sector.
+        """
+        ranked = {}
+        for (sector, key, key_type), hits in self._snapshot():
+            if sector in sectors:
+                pairs = ranked.setdefault(sector, [])
+                if len(pairs) < limit:
+                    pairs.append((key, key_type))
+        return ranked
+
+    def known(self, sectors=range(16)) -> dict:
+        """The most successful (key, key type) per sector."""
+        return {sector: pairs[0] for sector, pairs in self.candidates(sectors, 1).items()}
+
+    def _ordered(self, hits: Counter):
+        seen = set()
+        for key, _ in hits.most_common():
+            seen.add(key)
+            yield key
+        for key in self.keys:
+            if key not in seen:
+                yield key
+
+    def ordered_keys(self):
+        """All keys by total hits over all sectors, for the key-major attack."""
+        total_hits = Counter()
+        for (sector, key, key_type), hits in self._snapshot():
+            total_hits[key] += hits
+        return self._ordered(total_hits)
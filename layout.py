@@ -0,0 +1,224 @@
+import codecs
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+
+# sector, block, start and end are the same as in Card.get_data
+Field = namedtuple("Field", ["sector", "block", "start", "end", "kind"])
+
+PLANTAIN = {
+    "uid": Field(0, 0, 0, 7, "raw"),
+    "balance": Field(4, 0, 0, 3, "le"),
+    "last_day": Field(8, 0, 10, 13, "date"),
+    "passport_serial": Field(8, 1, 3, 8, "raw"),
+    "passport_number": Field(8, 1, 9, 12, "le"),
+    "underground_rides": Field(9, 0, 0, 4, "le"),
+    "lastname": Field(13, 0, 1, 34, "cp1251"),
+    "firstname_and_patronymic": Field(14, 0, 1, 47, "cp1251"),
+    "ekp_num": Field(32, 0, 1, 8, "be"),
+}
+
+# bytes.rstrip() whitespace, so text decoded from a view strips the same way
+_WHITESPACE = " \t\n\r\x0b\x0c"
+
+
+def _text(raw) -> str:
+    return codecs.decode(raw, "cp1251").rstrip(_WHITESPACE).rstrip("\x00")
+
+
+def _date(raw) -> str:
+    return f"{int(raw[2])-1}.{int(raw[1])}.{int(raw[0])+2000}"
+
+
+CONVERTERS = {
+    "raw": lambda raw: raw,
+    "le": lambda raw: int.from_bytes(raw, "little"),
+    "be": lambda raw: int.from_bytes(raw, "big"),
+    "cp1251": _text,
+    "date": _date,
+}
+
+# Little-endian ints of these widths are unpacked by struct itself
+_NATIVE_LE = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+# MIFARE Classic geometry: sectors 0-31 have 4 blocks, sectors 32-39 (4K only) have 16
+SECTOR_COUNT = {1024: 16, 4096: 40}
+SECTOR_BLOCKS = (4,) * 32 + (16,) * 8
+FIRST_BLOCK = tuple(sum(SECTOR_BLOCKS[:sector]) for sector in range(40))
+SECTOR_OFFSETS = tuple(block * 16 for block in FIRST_BLOCK)
+# Sector of each of the 256 blocks
+BLOCK_SECTOR = tuple(sector for sector in range(40) for _ in range(SECTOR_BLOCKS[sector]))
+
+
+def sector_size(sector: int) -> int:
+    return SECTOR_BLOCKS[sector] * 16
+
+
+@lru_cache(maxsize=None)
+def sector_spans(length: int) -> tuple:
+    """(sector, start, end) of every whole sector in a dump of `length` bytes."""
+    return tuple((sector, SECTOR_OFFSETS[sector], SECTOR_OFFSETS[sector] + sector_size(sector))
+                 for sector in range(40)
+                 if SECTOR_OFFSETS[sector] + sector_size(sector) <= length)
+
+
+def addr(sector: int, block: int, offset: int) -> int:
+    return SECTOR_OFFSETS[sector] + block * 16 + offset
+
+
+class SparseDump:
+    """A dump holding only the sectors that were actually read.
+
+    `sectors` maps sector numbers to their bytes, reading a missing sector
+    gives empty data, like reading past the end of a short dump.
+    """
+
+    def __init__(self, sectors=None):
+        self.sectors = dict(sectors or {})
+
+    @classmethod
+    def from_buffer(cls, buffer, sectors=None):
+        view = memoryview(buffer)
+        if sectors is None:
+            spans = sector_spans(len(view))
+        else:
+            spans = [(sector, SECTOR_OFFSETS[sector], SECTOR_OFFSETS[sector] + sector_size(sector))
+                     for sector in sectors]
+        return cls({sector: view[start:end] for sector, start, end in spans})
+
+    def __contains__(self, sector: int) -> bool:
+        return sector in self.sectors
+
+    def load(self, sectors):
+        """Hook for dumps that fetch sectors on demand, called before reading them."""
+        pass
+
+    def data(self, sector: int, block: int, start: int, end: int):
+        self.load((sector,))
+        sector_data = self.sectors.get(sector, b"")
+        return sector_data[block * 16 + start:block * 16 + end]
+
+    def to_bytes(self, size=None) -> bytes:
+        """A contiguous dump, sectors that weren't read are zero filled."""
+        if size is None:
+            size = 4096 if any(sector >= 16 for sector in self.sectors) else 1024
+        dump = bytearray(size)
+        for sector, sector_data in self.sectors.items():
+            dump[SECTOR_OFFSETS[sector]:SECTOR_OFFSETS[sector] + len(sector_data)] = sector_data
+        return bytes(dump[:size])
+
+
+def convert(field: Field, raw):
+    return CONVERTERS[field.kind](raw)
+
+
+class Decoder:
+    """Decodes a subset of layout fields with precompiled struct unpackers.
+
+    Fields are sorted by address and packed into as few struct.Struct
+    as possible, so a whole record is usually one unpack_from call.
+    Plans are compiled once per dump length (or per set of sectors of a
+    SparseDump), fields past the end of a short dump are sliced like
+    Card.get_data does.
+    """
+
+    def __init__(self, fields=None, layout=PLANTAIN):
+        self.layout = layout
+        self.fields = tuple(layout if fields is None else fields)
+        self._sectors = {layout[name].sector for name in self.fields}
+        self._plans = {}
+
+    def _pack(self, spans: list, length: int):
+        """Packs (start, end, name) spans of one buffer into structs.
+
+        Returns the struct groups and the spans that don't fit in `length`.
+        """
+        groups = []
+        outside = []
+        fmt, names, converters, base, pos = None, [], [], 0, 0
+
+        def flush():
+            if fmt is not None:
+                groups.append((struct.Struct(fmt), base, tuple(zip(names, converters))))
+
+        for start, end, name in sorted(spans):
+            field = self.layout[name]
+            if end > length or end <= start:
+                outside.append((name, start, end, CONVERTERS[field.kind]))
+                continue
+            if fmt is None or start < pos:  # overlapping fields go to a new struct
+                flush()
+                fmt, names, converters, base, pos = "<", [], [], start, start
+            if start > pos:
+                fmt += f"{start - pos}x"
+            width = end - start
+            if field.kind == "le" and width in _NATIVE_LE:
+                fmt += _NATIVE_LE[width]
+                converters.append(None)
+            else:
+                fmt += f"{width}s"
+                converters.append(CONVERTERS[field.kind])
+            names.append(name)
+            pos = end
+        flush()
+        return groups, outside
+
+    def _compile(self, length: int):
+        spans = []
+        for name in self.fields:
+            field = self.layout[name]
+            spans.append((addr(field.sector, field.block, field.start),
+                          addr(field.sector, field.block, field.end), name))
+        return self._pack(spans, length)
+
+    def _compile_sparse(self, lengths: tuple):
+        # One struct group list per sector, offsets relative to the sector
+        by_sector = {}
+        for name in self.fields:
+            field = self.layout[name]
+            by_sector.setdefault(field.sector, []).append(
+                (field.block * 16 + field.start, field.block * 16 + field.end, name))
+        lengths = dict(lengths)
+        return [(sector, *self._pack(spans, lengths.get(sector, 0)))
+                for sector, spans in by_sector.items()]
+
+    def decode_sparse(self, dump: SparseDump) -> dict:
+        dump.load(sorted(self._sectors))
+        key = tuple((sector, len(dump.sectors[sector]))
+                    for sector in sorted(dump.sectors) if sector in self._sectors)
+        plan = self._plans.get(key)
+        if plan is None:
+            if len(self._plans) > 64:
+                self._plans.clear()
+            plan = self._plans[key] = self._compile_sparse(key)
+
+        values = {}
+        for sector, groups, outside in plan:
+            sector_data = dump.sectors.get(sector, b"")
+            for unpacker, base, fields in groups:
+                for (name, converter), raw in zip(fields, unpacker.unpack_from(sector_data, base)):
+                    values[name] = converter(raw) if converter else raw
+            for name, start, end, converter in outside:
+                values[name] = converter(sector_data[start:end])
+        return values
+
+    def decode(self, buffer, offset=0) -> dict:
+        if isinstance(buffer, SparseDump):
+            return self.decode_sparse(buffer)
+        length = len(buffer) - offset
+        plan = self._plans.get(length)
+        if plan is None:
+            if len(self._plans) > 64:
+                self._plans.clear()
+            plan = self._plans[length] = self._compile(length)
+        groups, outside = plan
+
+        values = {}
+        for unpacker, base, fields in groups:
+            for (name, converter), raw in zip(fields, unpacker.unpack_from(buffer, offset + base)):
+                values[name] = converter(raw) if converter else raw
+        for name, start, end, converter in outside:
+            values[name] = converter(buffer[offset + start:offset + end])
+        return values
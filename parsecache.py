@@ -0,0 +1,136 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from time import time
+
+from card import RECORD_FIELDS, RECORD_VERSION, Card
+from sqlitedb import open_db
+from validate import INVALID
+
+# Bump when the table layout changes; RECORD_VERSION covers the records
+SCHEMA_VERSION = 1
+
+
+def dump_digest(buffer) -> bytes:
+    return hashlib.blake2b(buffer, digest_size=16).digest()
+
+
+def decode_record(card: Card) -> dict:
+    """The cacheable part of a batch record: every card field and the error."""
+    record = dict.fromkeys(RECORD_FIELDS)
+    record["error"] = None
+    try:
+        reason = card.validate()
+        if reason:
+            record["error"] = INVALID + reason
+        else:
+            record.update(card.to_dict())
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+
+class ParseCache:
+    """Decoded records in SQLite, keyed by a BLAKE2 digest of the dump bytes.
+
+    An unchanged dump costs one hash and one indexed lookup instead of a
+    decode. Writes and last-use stamps are buffered until flush(), so a
+    run over cached dumps barely writes. Once the stored records pass
+    `max_size` bytes the least recently used ones are evicted. A different
+    SCHEMA_VERSION or RECORD_VERSION empties the cache.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS records (digest BLOB PRIMARY KEY, record TEXT NOT NULL, "
+        "size INTEGER NOT NULL, used INTEGER NOT NULL) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS records_used ON records (used)",
+        "INSERT OR IGNORE INTO meta VALUES ('size', 0)",
+    )
+
+    def __init__(self, path="parsecache.sqlite", max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()  # sqlite3 connections can't cross threads
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = open_db(
+                self.path, {"schema": SCHEMA_VERSION, "record": RECORD_VERSION}, self.SCHEMA)
+            self._local.pending = {}
+            self._local.used = set()
+        return db
+
+    def get(self, digest: bytes):
+        db = self.db
+        pending = self._local.pending
+        if digest in pending:
+            return json.loads(pending[digest])
+        row = db.execute("SELECT record FROM records WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        self._local.used.add(digest)
+        return json.loads(row[0])
+
+    def put(self, digest: bytes, record: dict):
+        self.db  # the write buffers are per thread, like the connection
+        self._local.pending[digest] = json.dumps(record, ensure_ascii=False)
+
+    def record(self, card: Card, digest: bytes = None) -> dict:
+        """decode_record(card) from the cache, decoded and stored on a miss."""
+        if digest is None:
+            digest = dump_digest(card.dump)
+        record = self.get(digest)
+        if record is None:
+            record = decode_record(card)
+            self.put(digest, record)
+        return record
+
+    def flush(self):
+        db = self.db
+        pending, used = self._local.pending, self._local.used
+        if not pending and not used:
+            return
+        # Hourly stamps, so a dump used again in the same hour isn't rewritten
+        stamp = int(time()) // 3600
+        with db:
+            added = 0
+            for digest, record in pending.items():
+                cursor = db.execute("INSERT OR IGNORE INTO records VALUES (?, ?, ?, ?)",
+                                    (digest, record, len(record), stamp))
+                added += len(record) if cursor.rowcount == 1 else 0
+            db.executemany("UPDATE records SET used = ? WHERE digest = ? AND used < ?",
+                           [(stamp, digest, stamp) for digest in used])
+            db.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (added,))
+            size = db.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+            if size > self.max_size:
+                self._evict(db, size)
+        pending.clear()
+        used.clear()
+
+    def _evict(self, db: sqlite3.Connection, size: int):
+        # Down to 90% of max_size, so eviction doesn't run on every flush
+        target = self.max_size * 9 // 10
+        evicted = []
+        for digest, record_size in db.execute("SELECT digest, size FROM records ORDER BY used"):
+            if size <= target:
+                break
+            evicted.append((digest,))
+            size -= record_size
+        db.executemany("DELETE FROM records WHERE digest = ?", evicted)
+        db.execute("UPDATE meta SET value = ? WHERE name = 'size'", (size,))
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            self.flush()
+            db.close()
+            self._local.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
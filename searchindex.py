@@ -0,0 +1,198 @@
+import argparse
+import sys
+
+from batch import iter_dump_paths, map_chunks
+from card import RECORD_VERSION, Card
+from formats import file_version
+from sqlitedb import FileVersions, open_db
+from validate import uid_size
+
+# Bump when the table layout or the key normalization changes
+SCHEMA_VERSION = 3
+
+# Searchable keys, stored by their position in this tuple
+KINDS = ("number", "uid", "ekp_num", "passport", "name")
+# Record fields the keys other than the UID come from
+_KEY_FIELDS = ("number", "ekp_num", "passport", "name")
+_SEPARATORS = str.maketrans("", "", " -:\t")
+
+
+def normalize(kind: str, value) -> str:
+    """`value` as stored in and looked up from the index: card numbers, EKP
+    and passport numbers without separators, UIDs as lowercase hex, names
+    casefolded with single spaces. None if it can't be a `kind` key.
+    """
+    if value is None:
+        return None
+    if kind == "uid":
+        text = value.hex() if isinstance(value, (bytes, bytearray, memoryview)) \
+            else str(value).translate(_SEPARATORS).lower()
+        return text if text and all(c in "0123456789abcdef" for c in text) else None
+    if kind == "name":
+        return " ".join(str(value).split()).casefold() or None
+    text = str(value).translate(_SEPARATORS)
+    return text if text.isdigit() else None
+
+
+def dump_keys(card: Card) -> list:
+    """(kind, normalized value) of every key of a valid Plantain dump,
+    none for an invalid one.
+    """
+    if card.validate():
+        return []
+    values = card.to_dict(_KEY_FIELDS)
+    # The UID itself, without the BCC, SAK and ATQA bytes following a 4-byte one
+    block = card.get_data(0, 0, 0, 16)
+    values["uid"] = bytes(block[:uid_size(block)])
+    keys = []
+    for code, kind in enumerate(KINDS):
+        value = normalize(kind, values[kind])
+        if value is not None:
+            keys.append((code, value))
+    return keys
+
+
+def index_chunk(paths: list) -> list:
+    """(path, version, keys) of every path that still exists."""
+    entries = []
+    for path in paths:
+        version = file_version(path)
+        if version is None:
+            continue
+        try:
+            keys = dump_keys(Card.from_file(path))
+        except Exception:
+            keys = []  # indexed without keys, so it isn't decoded again until it changes
+        entries.append((path, version, keys))
+    return entries
+
+
+def _prefix_end(prefix: str) -> str:
+    # The smallest string greater than every string starting with `prefix`
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SearchIndex:
+    """Card numbers, UIDs, EKP and passport numbers and names of a dump
+    corpus in SQLite, for exact and prefix lookups without the dumps.
+
+    Every key is a row of one WITHOUT ROWID table ordered by (kind, value),
+    so both kinds of lookup are a single range scan of the primary key.
+    update() only decodes files whose size or mtime changed since they
+    were indexed. A different SCHEMA_VERSION or RECORD_VERSION empties
+    the index.
+    """
+
+    SCHEMA = FileVersions.SCHEMA + (
+        "CREATE TABLE IF NOT EXISTS keys (kind INTEGER NOT NULL, value TEXT NOT NULL, "
+        "file INTEGER NOT NULL, PRIMARY KEY (kind, value, file)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS keys_file ON keys (file)",
+    )
+
+    def __init__(self, path="searchindex.sqlite"):
+        self.path = path
+        self.db = open_db(path, {"schema": SCHEMA_VERSION, "record": RECORD_VERSION},
+                          self.SCHEMA)
+        self.files = FileVersions(self.db)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def add(self, entries):
+        """Stores index_chunk() entries in one transaction, replacing the
+        keys of paths indexed before.
+        """
+        with self.db as db:
+            for path, version, keys in entries:
+                file = self.files.mark(path, version)
+                db.execute("DELETE FROM keys WHERE file = ?", (file,))
+                db.executemany("INSERT OR IGNORE INTO keys VALUES (?, ?, ?)",
+                               [(kind, value, file) for kind, value in keys])
+
+    def update(self, paths, workers=None, chunksize=256) -> int:
+        """Indexes the new and changed files among `paths`, decoded in
+        `workers` processes; returns how many were (re)indexed.
+        """
+        count = 0
+        for entries in map_chunks(index_chunk, self.files.stale(paths), workers, chunksize):
+            self.add(entries)
+            count += len(entries)
+        return count
+
+    def prune(self) -> int:
+        """Drops the files that no longer exist, returns how many."""
+        gone = self.files.missing()
+        with self.db as db:
+            for path in gone:
+                db.execute("DELETE FROM keys WHERE file = (SELECT id FROM files WHERE path = ?)",
+                           (path,))
+                self.files.remove(path)
+        return len(gone)
+
+    def lookup(self, query: str, kind: str = None, prefix=False, limit=100) -> list:
+        """(kind, value, path) of the keys equal to `query`, or starting with
+        it if `prefix`, in every kind it can be a key of unless `kind` is given.
+        """
+        results = []
+        for code, key_kind in enumerate(KINDS):
+            if kind is not None and key_kind != kind:
+                continue
+            value = normalize(key_kind, query)
+            if value is None or len(results) >= limit:
+                continue
+            if prefix:
+                rows = self.db.execute(
+                    "SELECT value, path FROM keys JOIN files ON files.id = keys.file "
+                    "WHERE kind = ? AND value >= ? AND value < ? ORDER BY value LIMIT ?",
+                    (code, value, _prefix_end(value), limit - len(results)))
+            else:
+                rows = self.db.execute(
+                    "SELECT value, path FROM keys JOIN files ON files.id = keys.file "
+                    "WHERE kind = ? AND value = ? LIMIT ?", (code, value, limit - len(results)))
+            results += [(key_kind, key, path) for key, path in rows]
+        return results
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Find dumps by card number, UID, EKP or passport number or name")
+    parser.add_argument("--index", default="searchindex.sqlite", help="index file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    update = commands.add_parser("update", help="index new and changed dumps")
+    update.add_argument("sources", nargs="+", help="dump files, directories or glob patterns")
+    update.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes, defaults to the number of CPUs")
+    update.add_argument("--prune", action="store_true",
+                        help="also drop dumps that were deleted")
+    lookup = commands.add_parser("lookup", help="print the dumps with a key")
+    lookup.add_argument("query")
+    lookup.add_argument("-k", "--kind", choices=KINDS, help="only this kind of key")
+    lookup.add_argument("-p", "--prefix", action="store_true",
+                        help="keys starting with QUERY, not just equal to it")
+    lookup.add_argument("-n", "--limit", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    with SearchIndex(args.index) as index:
+        if args.command == "update":
+            count = index.update(iter_dump_paths(args.sources), args.workers)
+            pruned = index.prune() if args.prune else 0
+            print(f"{count} dumps indexed, {pruned} pruned, {len(index)} in the index",
+                  file=sys.stderr)
+            return 0
+        results = index.lookup(args.query, args.kind, args.prefix, args.limit)
+        for kind, value, path in results:
+            print(f"{kind}\t{value}\t{path}")
+        return 0 if results else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from batch import iter_dump_paths
+from formats import load_file
+from layout import SECTOR_COUNT, SparseDump, sector_size, sector_spans
+from sqlitedb import open_db
+
+# Bump when the pack or manifest layout changes
+SCHEMA_VERSION = 2
+# Sectors are stored 16-byte block aligned, manifests hold pack offsets in blocks
+_ALIGN = 16
+# A delta manifest is a list of (sector, pack offset) differing from its base
+_CHANGE = struct.Struct("<BI")
+# Dump length by the number of sectors in a full manifest
+_LENGTHS = {count: length for length, count in SECTOR_COUNT.items()}
+
+
+def sector_key(data) -> int:
+    """64-bit BLAKE2 digest of a sector, as an SQLite integer key.
+
+    Sectors found by it are compared byte for byte before they're reused,
+    so a collision costs a duplicate sector, never a wrong one.
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little", signed=True)
+
+
+class StoredDump(SparseDump):
+    """A dump of a SectorStore, stitched together from its sectors as they're read.
+
+    Sectors are memoryview slices of the store's mapped pack file, nothing
+    is copied until to_bytes(). validate() only checks the sectors loaded
+    so far, load_all() first to check the whole dump.
+    """
+
+    def __init__(self, store, length: int, offsets):
+        super().__init__()
+        self.length = length
+        self._store = store
+        self._offsets = offsets  # pack offset of every sector, in blocks
+
+    def load(self, sectors):
+        for sector in sectors:
+            if sector not in self.sectors and sector < len(self._offsets):
+                self.sectors[sector] = self._store.sector(self._offsets[sector], sector)
+
+    def load_all(self) -> "StoredDump":
+        self.load(range(len(self._offsets)))
+        return self
+
+    def to_bytes(self, size=None) -> bytes:
+        self.load_all()
+        return super().to_bytes(size or self.length)
+
+
+class SectorStore:
+    """Dumps split into sectors, every distinct sector stored once.
+
+    Sectors go to one append-only pack file, a SQLite table finds them by
+    digest when storing. The first dump of a card (by the pack offset of
+    its sector 0) is kept as a full manifest, the pack offsets of all its
+    sectors; later dumps of the card as a delta manifest of just the
+    sectors that differ from it, 5 bytes each. Dumps that differ only in
+    their balance and ride sectors cost little more than those sectors,
+    and reading one needs no digest lookups. Writes are committed by
+    flush(), the pack is synced first so a manifest never points past its
+    end; a crash leaves at most unused sectors behind.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS sectors (key INTEGER PRIMARY KEY, block INTEGER NOT NULL)",
+        # base is NULL for a full manifest, else the id of the full one it's a delta of
+        "CREATE TABLE IF NOT EXISTS dumps (id INTEGER PRIMARY KEY, base INTEGER, "
+        "manifest BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, dump INTEGER NOT NULL)"
+        " WITHOUT ROWID",
+        # The full manifest later dumps of a card are stored as deltas of
+        "CREATE TABLE IF NOT EXISTS bases (sector0 INTEGER PRIMARY KEY, dump INTEGER NOT NULL)",
+    )
+
+    def __init__(self, path="sectorstore"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.pack = open(os.path.join(path, "sectors.pack"), "a+b")
+        end = self.pack.seek(0, os.SEEK_END)
+        if end % _ALIGN:
+            self.pack.write(bytes(-end % _ALIGN))  # torn by a crash, nothing refers to it
+        self._map = None
+        self._bases = {}  # dump id -> offsets of recently read full manifests
+        # Unlike a cache, the dumps can't be rebuilt from anything else
+        self.db = open_db(os.path.join(path, "manifests.sqlite"), {"schema": SCHEMA_VERSION},
+                          self.SCHEMA, disposable=False)
+
+    def _append(self, data, sector: int) -> int:
+        # Pack offset of `data` in blocks, appended if no sector like it is stored yet
+        key = sector_key(data)
+        row = self.db.execute("SELECT block FROM sectors WHERE key = ?", (key,)).fetchone()
+        if row is not None and self.sector(row[0], sector) == data:
+            return row[0]
+        block = self.pack.tell() // _ALIGN
+        self.pack.write(data)
+        if row is None:
+            self.db.execute("INSERT INTO sectors VALUES (?, ?)", (key, block))
+        return block
+
+    def _full(self, dump: int) -> array:
+        offsets = self._bases.get(dump)
+        if offsets is None:
+            manifest, = self.db.execute("SELECT manifest FROM dumps WHERE id = ?",
+                                        (dump,)).fetchone()
+            if len(self._bases) >= 1024:
+                self._bases.clear()
+            offsets = self._bases[dump] = array("I", manifest)
+        return offsets
+
+    def _offsets(self, base, manifest: bytes) -> array:
+        if base is None:
+            return array("I", manifest)
+        offsets = array("I", self._full(base))
+        for sector, block in _CHANGE.iter_unpack(manifest):
+            offsets[sector] = block
+        return offsets
+
+    def put(self, name: str, dump):
+        """Stores (or replaces) the dump `name`, committed by the next flush()."""
+        view = memoryview(dump)
+        if len(view) not in SECTOR_COUNT:
+            raise ValueError(f"{len(view)} bytes is not a MIFARE Classic 1K or 4K dump")
+        offsets = array("I", (self._append(view[start:end], sector)
+                              for sector, start, end in sector_spans(len(view))))
+        base = self.db.execute("SELECT dump FROM bases WHERE sector0 = ?",
+                               (offsets[0],)).fetchone()
+        changes = None
+        if base is not None:
+            base_offsets = self._full(base[0])
+            if len(base_offsets) == len(offsets):
+                changes = [(sector, block) for sector, (block, base_block)
+                           in enumerate(zip(offsets, base_offsets)) if block != base_block]
+        if changes is not None and len(changes) <= len(offsets) // 4:
+            dump_id = self.db.execute(
+                "INSERT INTO dumps (base, manifest) VALUES (?, ?)",
+                (base[0], b"".join(_CHANGE.pack(*change) for change in changes))).lastrowid
+        else:
+            # Too different from the card's base, or its first dump: the new base
+            dump_id = self.db.execute("INSERT INTO dumps (base, manifest) VALUES (NULL, ?)",
+                                      (offsets.tobytes(),)).lastrowid
+            self.db.execute("INSERT OR REPLACE INTO bases VALUES (?, ?)", (offsets[0], dump_id))
+        old = self.db.execute("SELECT dump FROM names WHERE name = ?", (name,)).fetchone()
+        self.db.execute("INSERT OR REPLACE INTO names VALUES (?, ?)", (name, dump_id))
+        if old is not None:
+            # Full manifests stay, deltas of other dumps may refer to them
+            self.db.execute("DELETE FROM dumps WHERE id = ? AND base IS NOT NULL", old)
+
+    def flush(self):
+        self.pack.flush()
+        os.fsync(self.pack.fileno())
+        self.db.commit()
+
+    def sector(self, block: int, sector: int) -> memoryview:
+        """Sector `sector` stored at pack offset `block`, as a view of the mapped pack."""
+        start = block * _ALIGN
+        end = start + sector_size(sector)
+        if self._map is None or end > len(self._map):
+            # The pack grew since it was mapped; views of the old mapping stay valid
+            self.pack.flush()
+            self._map = memoryview(mmap.mmap(self.pack.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._map[start:end]
+
+    def _stored(self, base, manifest: bytes) -> StoredDump:
+        offsets = self._offsets(base, manifest)
+        return StoredDump(self, _LENGTHS[len(offsets)], offsets)
+
+    def get(self, name: str) -> StoredDump:
+        """The dump `name` as a lazily stitched StoredDump, None if there's none.
+
+        Card(store.get(name)) decodes it reading only the sectors it needs.
+        """
+        row = self.db.execute("SELECT base, manifest FROM names JOIN dumps ON dumps.id = dump "
+                              "WHERE name = ?", (name,)).fetchone()
+        return None if row is None else self._stored(*row)
+
+    def get_bytes(self, name: str) -> bytes:
+        dump = self.get(name)
+        return None if dump is None else dump.to_bytes()
+
+    def __contains__(self, name: str) -> bool:
+        return self.db.execute("SELECT 1 FROM names WHERE name = ?", (name,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM names").fetchone()[0]
+
+    def items(self):
+        """(name, StoredDump) of every dump, in name order, in one table scan."""
+        for name, base, manifest in self.db.execute(
+                "SELECT name, base, manifest FROM names JOIN dumps ON dumps.id = dump "
+                "ORDER BY name"):
+            yield name, self._stored(base, manifest)
+
+    def stats(self) -> dict:
+        """Counts and sizes, with everything flushed and the SQLite WAL
+        checkpointed into the database file so it's measured too.
+        """
+        self.flush()
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        dumps = len(self)
+        logical = sum(_LENGTHS[len(self._offsets(base, manifest))] for base, manifest in
+                      self.db.execute("SELECT base, manifest FROM names "
+                                      "JOIN dumps ON dumps.id = dump"))
+        sectors = self.db.execute("SELECT count(*) FROM sectors").fetchone()[0]
+        pack = os.path.getsize(self.pack.name)
+        manifests = sum(os.path.getsize(os.path.join(self.path, name))
+                        for name in ("manifests.sqlite", "manifests.sqlite-wal")
+                        if os.path.exists(os.path.join(self.path, name)))
+        stored = pack + manifests
+        return {"dumps": dumps, "sectors": sectors, "dump_bytes": logical,
+                "pack_bytes": pack, "manifest_bytes": manifests, "stored_bytes": stored,
+                "ratio": round(logical / stored, 1) if stored else 0.0}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+        self._map = None
+        self.pack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Archive dumps storing every distinct sector once")
+    parser.add_argument("--store", default="sectorstore", help="store directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    put = commands.add_parser("import", help="store dump files under their paths")
+    put.add_argument("sources", nargs="+", help="dump files, directories or glob patterns")
+    get = commands.add_parser("export", help="write a stored dump as a binary file")
+    get.add_argument("name")
+    get.add_argument("-o", "--output", help="defaults to the dump's base name")
+    commands.add_parser("stats", help="print dump and sector counts and sizes")
+    args = parser.parse_args(argv)
+
+    with SectorStore(args.store) as store:
+        if args.command == "import":
+            count = 0
+            for path in iter_dump_paths(args.sources):
+                try:
+                    store.put(path, load_file(path))
+                except (OSError, ValueError) as e:
+                    print(f"Skipping {path}: {e}", file=sys.stderr)
+                    continue
+                count += 1
+                if count % 10000 == 0:
+                    store.flush()
+            print(f"{count} dumps stored", file=sys.stderr)
+        elif args.command == "export":
+            dump = store.get_bytes(args.name)
+            if dump is None:
+                print(f"No dump named {args.name}", file=sys.stderr)
+                return 1
+            with open(args.output or os.path.basename(args.name), "wb") as dump_file:
+                dump_file.write(dump)
+        else:
+            for name, value in store.stats().items():
+                print(f"{name}\t{value}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+from collections import Counter
+from time import sleep
+
+from smartcard.Exceptions import CardConnectionException, NoCardException
+
+from layout import BLOCK_SECTOR, FIRST_BLOCK, SECTOR_BLOCKS, SECTOR_COUNT
+
+# ACR122U ATR of a MIFARE Classic card, the card name goes in bytes 13-14
+_ATR = [0x3B, 0x8F, 0x80, 0x01, 0x80, 0x4F, 0x0C, 0xA0, 0x00, 0x00, 0x03, 0x06, 0x03,
+        0x00, 0x01, 0x00, 0x00, 0x00, 0x00]
+_CARD_NAMES = {1024: 0x01, 4096: 0x02}
+_FIRMWARE = b"ACR122U207"
+
+# INS byte -> name counted in SimulatedReader.stats
+COMMANDS = {0xCA: "getuid", 0x00: "pseudo", 0x82: "loadkey", 0x86: "auth", 0xB0: "read"}
+
+OK = (0x90, 0x00)
+ERROR = (0x63, 0x00)
+
+
+def _trailer_keys(dump: bytes, sector: int) -> tuple:
+    trailer = FIRST_BLOCK[sector] * 16 + (SECTOR_BLOCKS[sector] - 1) * 16
+    return dump[trailer:trailer + 6].hex(), dump[trailer + 10:trailer + 16].hex()
+
+
+class SimulatedCard:
+    """A MIFARE Classic 1K/4K card serving the blocks of a dump.
+
+    `keys` maps sectors to (key A, key B) hex strings, sectors missing from
+    it use the keys from their trailers. Dumps read by a reader have key A
+    zeroed in the trailers, so pass the real keys for those.
+    """
+
+    def __init__(self, dump: bytes, keys=None):
+        if len(dump) not in SECTOR_COUNT:
+            raise ValueError(f"Dump must be 1024 or 4096 bytes, not {len(dump)}")
+        self.dump = bytes(dump)
+        self.sector_count = SECTOR_COUNT[len(dump)]
+        keys = keys or {}
+        self.keys = {sector: tuple(key.lower() for key in keys[sector]) if sector in keys
+                     else _trailer_keys(self.dump, sector)
+                     for sector in range(self.sector_count)}
+
+    @classmethod
+    def from_file(cls, path: str, keys=None):
+        with open(path, "rb") as dump_file:
+            return cls(dump_file.read(), keys)
+
+    @property
+    def uid(self) -> bytes:
+        return self.dump[0:4]
+
+    @property
+    def atr(self) -> list:
+        atr = _ATR[:]
+        atr[14] = _CARD_NAMES[len(self.dump)]
+        tck = 0
+        for byte in atr[1:]:
+            tck ^= byte
+        return atr + [tck]
+
+    def read_block(self, block: int) -> bytes:
+        data = self.dump[block * 16:block * 16 + 16]
+        sector = BLOCK_SECTOR[block]
+        if block + 1 == FIRST_BLOCK[sector] + SECTOR_BLOCKS[sector]:
+            # Key A of a sector trailer always reads as zeros
+            data = bytes(6) + data[6:]
+        return data
+
+
+class SimulatedConnection:
+    """The part of pyscard's CardConnection that acr122ulib uses."""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.card = None
+        self.key_slots = {}
+        self.auth = None  # sector the card is authenticated for
+        self.halted = False  # by a failed authentication, until selected again
+
+    def connect(self):
+        if self.reader.card is None:
+            raise NoCardException("No card in the simulated reader")
+        self.card = self.reader.card
+        self.reader.stats["connect"] += 1
+
+    def disconnect(self):
+        self.card = None
+        self.auth = None
+        self.halted = False
+
+    def getATR(self) -> list:
+        return self.card.atr
+
+    def transmit(self, command: list):
+        reader = self.reader
+        if self.card is None or reader.card is not self.card:
+            raise CardConnectionException("Card removed from the simulated reader")
+        ins = command[1]
+        reader.stats[COMMANDS.get(ins, "unknown")] += 1
+        latency = reader.latency.get(ins, 0) if isinstance(reader.latency, dict) else reader.latency
+        if latency:
+            sleep(latency)
+        data, (sw1, sw2) = self._execute(ins, command)
+        return list(data), sw1, sw2
+
+    def _execute(self, ins: int, command: list):
+        if ins == 0xCA:
+            return self.card.uid, OK
+        if ins == 0x00 and command[2] == 0x48:
+            # pyscard takes the last two bytes of the version for the status word
+            return _FIRMWARE[:-2], tuple(_FIRMWARE[-2:])
+        if ins == 0x00 and command[2] == 0x52:  # buzzer on card detection
+            return b"", OK
+        if ins == 0x00 and command[5:7] == [0xD4, 0x4A]:  # InListPassiveTarget
+            self.reader.stats["select"] += 1
+            self.halted = False
+            self.auth = None
+            uid = self.card.uid
+            return bytes([0xD5, 0x4B, 0x01, 0x01, 0x00, 0x04, 0x08, len(uid)]) + uid, OK
+        if ins == 0x82 and len(command) == 11:
+            self.key_slots[command[3]] = bytes(command[5:11]).hex()
+            return b"", OK
+        if ins == 0x86:
+            return b"", self._authenticate(command[7], command[8], command[9])
+        if ins == 0xB0:
+            block = command[3]
+            if self.auth is None or BLOCK_SECTOR[block] != self.auth:
+                return b"", ERROR
+            return self.card.read_block(block), OK
+        return b"", (0x6A, 0x81)
+
+    def _authenticate(self, block: int, key_type: int, slot: int):
+        self.reader.stats["auth_attempts"] += 1
+        sector = BLOCK_SECTOR[block]
+        self.auth = None
+        if (self.halted or sector >= self.card.sector_count or key_type not in (0x60, 0x61)
+                or self.key_slots.get(slot) != self.card.keys[sector][key_type - 0x60]):
+            # Like a real card, it answers nothing more until it's selected again
+            self.reader.stats["auth_failures"] += 1
+            self.halted = True
+            return ERROR
+        self.auth = sector
+        return OK
+
+
+class SimulatedReader:
+    """An in-process ACR122U that can stand in for a pyscard reader.
+
+    Implements get UID, firmware version, LOAD KEY, GENERAL AUTHENTICATE,
+    READ BINARY and selecting the card again by InListPassiveTarget, which
+    a failed authentication requires before the card answers again, as
+    with real cards. `latency` is the delay of every APDU in seconds, or a dict
+    of delays by INS byte. `stats` counts connections, APDUs by command and
+    authentication attempts and failures.
+    """
+
+    def __init__(self, card: SimulatedCard = None, latency=0.0, name="Simulated ACR122U 00 00"):
+        self.card = card
+        self.latency = latency
+        self.name = name
+        self.stats = Counter()
+
+    def __str__(self):
+        return self.name
+
+    def createConnection(self) -> SimulatedConnection:
+        return SimulatedConnection(self)
+
+    def insert(self, card: SimulatedCard):
+        self.card = card
+
+    def remove(self):
+        self.card = None
+
+    def apdus(self) -> int:
+        return sum(self.stats[name] for name in set(COMMANDS.values()) | {"unknown"})
@@ -0,0 +1,86 @@
+import os
+import sqlite3
+
+from formats import file_version
+
+
+def open_db(path: str, versions: dict, schema, disposable=True, timeout=60) -> sqlite3.Connection:
+    """Connects to the SQLite database in `path` and sets it up.
+
+    `versions` ({name: number}) are kept in its meta table. If they differ
+    from the stored ones every table is dropped when the data is
+    `disposable`, i.e. can be rebuilt from the dumps, otherwise ValueError
+    is raised. `schema` statements (CREATE ... IF NOT EXISTS) then run in
+    the same transaction.
+    """
+    db = sqlite3.connect(path, timeout=timeout)
+    try:
+        # WAL lets batch worker processes read while one of them writes
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            db.execute("BEGIN IMMEDIATE")  # another process may be setting up too
+            db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            stored = dict(db.execute("SELECT name, value FROM meta"))
+            if any(stored.get(name) != version for name, version in versions.items()):
+                if stored and not disposable:
+                    raise ValueError(f"{path} has versions {stored}, expected {versions}")
+                tables = db.execute("SELECT name FROM sqlite_master "
+                                    "WHERE type = 'table' AND name != 'meta'").fetchall()
+                for table, in tables:
+                    db.execute(f'DROP TABLE "{table}"')
+                db.execute("DELETE FROM meta")
+                db.executemany("INSERT INTO meta VALUES (?, ?)", versions.items())
+            for statement in schema:
+                db.execute(statement)
+    except BaseException:
+        db.close()
+        raise
+    return db
+
+
+class FileVersions:
+    """The files a store was built from and their versions, (size, mtime_ns),
+    in its `files` table; anything the store derived from a file refers to
+    its id.
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, "
+              "path TEXT NOT NULL UNIQUE, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)",)
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM files").fetchone()[0]
+
+    def get(self, path: str):
+        """(id, size, mtime_ns) of `path`, None if it isn't known."""
+        return self.db.execute("SELECT id, size, mtime_ns FROM files WHERE path = ?",
+                               (path,)).fetchone()
+
+    def stale(self, paths):
+        """Paths that aren't known or changed since they were marked."""
+        for path in paths:
+            row = self.get(path)
+            if row is None or tuple(row[1:]) != file_version(path):
+                yield path
+
+    def mark(self, path: str, version: tuple) -> int:
+        """Records `version` of `path`, returns its id."""
+        size, mtime_ns = version
+        row = self.get(path)
+        if row is None:
+            return self.db.execute("INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                                   (path, size, mtime_ns)).lastrowid
+        self.db.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?",
+                        (size, mtime_ns, row[0]))
+        return row[0]
+
+    def remove(self, path: str):
+        self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def missing(self) -> list:
+        """Paths of the known files that no longer exist."""
+        return [path for path, in self.db.execute("SELECT path FROM files")
+                if not os.path.exists(path)]
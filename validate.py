@@ -0,0 +1,149 @@
+import codecs
+
+from layout import PLANTAIN, SECTOR_BLOCKS, SECTOR_COUNT, SparseDump
+
+REASONS = ("length", "uid_bcc", "access_bits", "value_block",
+           "name_encoding", "last_day", "passport")
+# Record error of a dump that failed validation, followed by the reason
+INVALID = "invalid dump: "
+
+# Sectors check_plantain reads
+_PLANTAIN_SECTORS = {PLANTAIN[name].sector for name in
+                     ("lastname", "firstname_and_patronymic", "last_day", "passport_serial")}
+
+
+def uid_size(block) -> int:
+    """Length of the UID at the start of the manufacturer block, 0 if neither
+    a 4-byte UID with its BCC nor a 7-byte one.
+    """
+    if block[0] ^ block[1] ^ block[2] ^ block[3] == block[4]:
+        return 4
+    # 7-byte UIDs have no BCC, their ATQA (bytes 8-9) says double size UID
+    if block[8] in (0x42, 0x44) and block[9] == 0x00:
+        return 7
+    return 0
+
+
+def check_uid(block) -> str:
+    return None if uid_size(block) else "uid_bcc"
+
+
+def check_access_bits(sectors: list, b6: bytes, b7: bytes, b8: bytes):
+    """Checks the access bits (bytes 6-8) of the trailers of `sectors` all
+    at once, each byte string holding that byte of every trailer.
+
+    Returns "access_bits" if any of them differs from its inverted copy,
+    otherwise a list of (sector, mask) of the data block groups (bits 0-2)
+    the access conditions make value blocks.
+    """
+    count = len(sectors)
+    low = int.from_bytes(b"\x0f" * count, "big")  # the low nibble of every byte
+    x6, x7, x8 = (int.from_bytes(trailers, "big") for trailers in (b6, b7, b8))
+    c1, c2, c3 = x7 >> 4 & low, x8 & low, x8 >> 4 & low
+    if x6 & low ^ c1 != low or x6 >> 4 & low ^ c2 != low or x7 & low ^ c3 != low:
+        return "access_bits"
+    # NXP's value block access conditions, (C1, C2, C3) = 110 or 001
+    groups = (c1 & c2 & (c3 ^ low) | (c1 ^ low) & (c2 ^ low) & c3) \
+        & int.from_bytes(b"\x07" * count, "big")
+    if not groups:
+        return []
+    return [(sector, mask) for sector, mask in zip(sectors, groups.to_bytes(count, "big")) if mask]
+
+
+def _value_block_ok(block) -> bool:
+    value, inverted, copy = block[0:4], block[4:8], block[8:12]
+    if value != copy or int.from_bytes(value, "little") ^ int.from_bytes(inverted, "little") \
+            != 0xFFFFFFFF:
+        return False
+    return block[12] == block[14] and block[12] ^ block[13] == 0xFF and block[13] == block[15]
+
+
+def check_value_blocks(sectors: dict, value_groups: list) -> str:
+    for sector, groups in value_groups:
+        data = sectors[sector]
+        # Blocks of the big 4K sectors share their group's conditions 5 at a time
+        per_group = 1 if SECTOR_BLOCKS[sector] == 4 else 5
+        for block in range(SECTOR_BLOCKS[sector] - 1):
+            if sector == 0 and block == 0:
+                continue  # manufacturer block
+            if groups >> (block // per_group) & 1 \
+                    and not _value_block_ok(data[block * 16:block * 16 + 16]):
+                return "value_block"
+    return None
+
+
+def _field(sectors: dict, name: str):
+    field = PLANTAIN[name]
+    data = sectors.get(field.sector)
+    if data is None:
+        return None
+    return data[field.block * 16 + field.start:field.block * 16 + field.end]
+
+
+def check_plantain(sectors: dict) -> str:
+    """Names must be cp1251 text; benefit cards need a sane last day and
+    a readable passport serial.
+    """
+    names = [_field(sectors, "lastname"), _field(sectors, "firstname_and_patronymic")]
+    if None in names:
+        return None
+    try:
+        benefit = any(codecs.decode(name, "cp1251").rstrip().rstrip("\x00") for name in names)
+    except UnicodeDecodeError:
+        return "name_encoding"
+    if not benefit:
+        return None
+    last_day = _field(sectors, "last_day")
+    if last_day is not None and not (1 <= last_day[1] <= 12 and 2 <= last_day[2] <= 32):
+        return "last_day"
+    serial = _field(sectors, "passport_serial")
+    if serial is not None:
+        try:
+            str(serial, "utf-8")
+        except UnicodeDecodeError:
+            return "passport"
+    return None
+
+
+def _trailer_bytes(view: memoryview, length: int):
+    # Bytes 6-8 of every trailer straight from the buffer, by strided slices
+    for byte in (6, 7, 8):
+        trailers = bytes(view[48 + byte:min(length, 2048):64])
+        if length > 2048:
+            trailers += bytes(view[2048 + 240 + byte::256])
+        yield trailers
+
+
+def validate(dump) -> str:
+    """The reason `dump` is not a valid Plantain dump (one of REASONS),
+    None if it is. Checks run cheapest first and stop at the first failure.
+
+    `dump` is a buffer or a SparseDump; sectors a SparseDump lacks are
+    not checked and neither is its length.
+    """
+    if isinstance(dump, SparseDump):
+        sectors = {sector: data for sector, data in dump.sectors.items()
+                   if len(data) == SECTOR_BLOCKS[sector] * 16}
+        if 0 in sectors and check_uid(sectors[0]):
+            return "uid_bcc"
+        numbers = sorted(sectors)
+        trailers = [bytes(sectors[sector][(SECTOR_BLOCKS[sector] - 1) * 16 + byte]
+                          for sector in numbers) for byte in (6, 7, 8)]
+    else:
+        view = memoryview(dump)
+        length = len(view)
+        if length not in SECTOR_COUNT:
+            return "length"
+        if check_uid(view[0:16]):
+            return "uid_bcc"
+        numbers = range(SECTOR_COUNT[length])
+        trailers = _trailer_bytes(view, length)
+        sectors = None
+    value_groups = check_access_bits(numbers, *trailers)
+    if isinstance(value_groups, str):
+        return value_groups
+    if sectors is None:
+        # Only the sectors the remaining checks read
+        sectors = SparseDump.from_buffer(
+            view, {sector for sector, groups in value_groups} | _PLANTAIN_SECTORS).sectors
+    return check_value_blocks(sectors, value_groups) or check_plantain(sectors)
@@ -0,0 +1,327 @@
+import argparse
+import fnmatch
+import json
+import os
+import queue
+import sys
+import threading
+from time import monotonic, sleep
+
+from batch import parse_file
+from formats import file_version
+from parsecache import ParseCache
+from searchindex import SearchIndex
+from sqlitedb import FileVersions, open_db
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # falls back to polling
+    FileSystemEventHandler = object
+    Observer = None
+
+
+# Whatever formats.load_file reads
+DUMP_PATTERNS = ("*.bin", "*.mfd", "*.eml", "*.json")
+# Bump when the checkpoint's table layout changes
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint:
+    """Which file versions are already in the output, in SQLite.
+
+    save() commits the versions marked since the last one together with
+    the output's size at that moment, so a batch costs its own rows, not
+    a rewrite of every file seen; records appended after the last save
+    are recovered from the output on restart. Losing the checkpoint
+    altogether only means recovering the whole output.
+    """
+
+    SCHEMA = FileVersions.SCHEMA + ("INSERT OR IGNORE INTO meta VALUES ('output_size', 0)",)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = open_db(path, {"schema": CHECKPOINT_VERSION}, self.SCHEMA)
+        self.files = FileVersions(self.db)
+        self.output_size = self.db.execute(
+            "SELECT value FROM meta WHERE name = 'output_size'").fetchone()[0]
+
+    def done(self, path: str, version: tuple) -> bool:
+        row = self.files.get(path)
+        return row is not None and tuple(row[1:]) == version
+
+    def mark(self, path: str, version: tuple):
+        self.files.mark(path, version)
+
+    def save(self, output_size: int):
+        self.output_size = output_size
+        with self.db as db:
+            db.execute("UPDATE meta SET value = ? WHERE name = 'output_size'", (output_size,))
+
+    def close(self):
+        self.db.close()
+
+
+class PollingWatcher:
+    """Finds new and changed files by polling.
+
+    Only directories whose mtime changed (a file was added, renamed or
+    removed) are listed again on every poll, the whole tree is rescanned
+    every `rescan` seconds to catch files rewritten in place.
+    """
+
+    def __init__(self, directory: str, rescan=60.0):
+        self.directory = directory
+        self.rescan = rescan
+        self._dirs = {}  # directory -> mtime_ns
+        self._children = {}  # directory -> its subdirectories when it was last listed
+        self._last_rescan = None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def poll(self):
+        now = monotonic()
+        full = self._last_rescan is None or now - self._last_rescan >= self.rescan
+        if full:
+            self._last_rescan = now
+        for root, dirs, files in self._walk(full):
+            for name in files:
+                yield os.path.join(root, name)
+
+    def _walk(self, full: bool):
+        stack = [self.directory]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+                entries = list(os.scandir(directory)) if full or self._dirs.get(directory) != mtime \
+                    else None
+            except OSError:
+                self._forget(directory)
+                continue
+            self._dirs[directory] = mtime
+            if entries is None:
+                # Unchanged, but its subdirectories may not be
+                stack.extend(self._children.get(directory, ()))
+                continue
+            dirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+            for gone in set(self._children.get(directory, ())).difference(dirs):
+                self._forget(gone)
+            self._children[directory] = dirs
+            stack.extend(dirs)
+            yield directory, dirs, sorted(entry.name for entry in entries
+                                          if entry.is_file(follow_symlinks=False))
+
+
+    def _forget(self, directory: str):
+        self._dirs.pop(directory, None)
+        for child in self._children.pop(directory, ()):
+            self._forget(child)
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, events: queue.Queue):
+        super().__init__()
+        self.events = events
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.events.put(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.events.put(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.events.put(event.dest_path)
+
+
+class NotifyWatcher:
+    """Gets new and changed files from inotify (or the platform's
+    equivalent) through watchdog. The first poll lists the whole tree to
+    pick up files added while nobody was watching.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.events = queue.Queue()
+        self.observer = Observer()
+        self.observer.schedule(_EventHandler(self.events), directory, recursive=True)
+        self._initial = PollingWatcher(directory)
+
+    def start(self):
+        self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+    def poll(self):
+        if self._initial is not None:
+            yield from self._initial.poll()
+            self._initial = None
+        while True:
+            try:
+                yield self.events.get_nowait()
+            except queue.Empty:
+                return
+
+
+class Ingester:
+    """Parses every dump dropped into `directory` exactly once.
+
+    A file is parsed once its size and mtime haven't changed for `settle`
+    seconds, so half-written files are never read. Records are appended
+    to `output` as JSON Lines, the checkpoint remembers which file
+    versions they came from; after a crash records written past the last
+    checkpoint are recovered from the output instead of parsed again.
+    With a SearchIndex every parsed file is indexed too.
+    """
+
+    def __init__(self, directory: str, output: str, checkpoint: str = None,
+                 patterns=DUMP_PATTERNS, settle=2.0, polling=False, interval=1.0,
+                 cache: ParseCache = None, index: SearchIndex = None):
+        self.directory = directory
+        self.patterns = tuple(patterns)
+        self.settle = settle
+        self.interval = interval
+        self.cache = cache
+        self.index = index
+        self.checkpoint = Checkpoint(checkpoint or output + ".checkpoint")
+        self.output = open(output, "ab+")
+        self._recover()
+        if polling or Observer is None:
+            self.watcher = PollingWatcher(directory)
+        else:
+            self.watcher = NotifyWatcher(directory)
+        self.pending = {}  # path -> (version, monotonic time it was first seen)
+        self.parsed = 0
+
+    def _recover(self):
+        self.output.seek(0, os.SEEK_END)
+        size = self.output.tell()
+        if size <= self.checkpoint.output_size:
+            return
+        self.output.seek(self.checkpoint.output_size)
+        end = self.checkpoint.output_size
+        for line in self.output:
+            if not line.endswith(b"\n"):
+                break  # torn by the crash, that file is parsed again
+            path = json.loads(line)["path"]
+            version = file_version(path)
+            if version is not None:
+                self.checkpoint.mark(path, version)
+            end += len(line)
+        self.output.truncate(end)
+        self.output.seek(end)
+        self.checkpoint.save(end)
+
+    def step(self) -> int:
+        """Handles everything the watcher reported, returns how many files were parsed."""
+        now = monotonic()
+        for path in self.watcher.poll():
+            name = os.path.basename(path)
+            if path in self.pending or not any(fnmatch.fnmatch(name, pattern)
+                                               for pattern in self.patterns):
+                continue
+            version = file_version(path)
+            if version is not None and not self.checkpoint.done(path, version):
+                self.pending[path] = (version, now)
+
+        parsed = []
+        for path, (version, seen) in list(self.pending.items()):
+            current = file_version(path)
+            if current is None:
+                del self.pending[path]
+            elif current != version:
+                self.pending[path] = (current, now)  # still being written
+            elif now - seen >= self.settle:
+                del self.pending[path]
+                if not self.checkpoint.done(path, version):
+                    self._write(parse_file(path, cache=self.cache))
+                    self.checkpoint.mark(path, version)
+                    parsed.append(path)
+        if parsed:
+            if self.cache is not None:
+                self.cache.flush()
+            if self.index is not None:
+                self.index.update(parsed, workers=1)
+            self.output.flush()
+            os.fsync(self.output.fileno())
+            self.checkpoint.save(self.output.tell())
+            self.parsed += len(parsed)
+        return len(parsed)
+
+    def _write(self, record: dict):
+        self.output.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    def run(self, stop: threading.Event = None, on_parsed=None):
+        self.watcher.start()
+        try:
+            while not (stop and stop.is_set()):
+                parsed = self.step()
+                if parsed and on_parsed:
+                    on_parsed(self.parsed)
+                if stop:
+                    stop.wait(self.interval)
+                else:
+                    sleep(self.interval)
+        finally:
+            self.watcher.stop()
+
+    def close(self):
+        self.output.close()
+        self.checkpoint.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.index is not None:
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parse every dump dropped into a folder, exactly once")
+    parser.add_argument("directory", help="folder the dumps are written to")
+    parser.add_argument("-o", "--output", default="cards.jsonl",
+                        help="JSON Lines file the records are appended to")
+    parser.add_argument("--checkpoint", help="defaults to OUTPUT.checkpoint")
+    parser.add_argument("--pattern", type=lambda value: value.split(","),
+                        default=DUMP_PATTERNS, help="comma separated dump file name "
+                        "patterns, by default " + ",".join(DUMP_PATTERNS))
+    parser.add_argument("--settle", type=float, default=2.0, metavar="SECONDS",
+                        help="parse a file once it hasn't changed for SECONDS")
+    parser.add_argument("--interval", type=float, default=1.0, metavar="SECONDS")
+    parser.add_argument("--polling", action="store_true",
+                        help="poll even if watchdog is installed")
+    parser.add_argument("--cache", nargs="?", const="parsecache.sqlite", metavar="FILE",
+                        help="reuse records of dumps parsed before from a SQLite cache")
+    parser.add_argument("--index", nargs="?", const="searchindex.sqlite", metavar="FILE",
+                        help="also add the dumps to a search index, see searchindex.py")
+    args = parser.parse_args(argv)
+
+    cache = ParseCache(args.cache) if args.cache else None
+    index = SearchIndex(args.index) if args.index else None
+    with Ingester(args.directory, args.output, args.checkpoint, args.pattern, args.settle,
+                  args.polling, args.interval, cache, index) as ingester:
+        mode = "polling" if isinstance(ingester.watcher, PollingWatcher) else "notifications"
+        print(f"Watching {args.directory} ({mode})", file=sys.stderr)
+        try:
+            ingester.run(on_parsed=lambda count: print(f"{count} dumps parsed", file=sys.stderr))
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
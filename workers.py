@@ -0,0 +1,297 @@
+import multiprocessing
+import os
+import threading
+from datetime import datetime
+from time import monotonic
+
+from PyQt5 import QtCore
+
+from batch import iter_dump_paths, parse_files
+from card import Card, available_fields
+from parsecache import ParseCache
+from validate import INVALID
+
+
+class DumpThread(QtCore.QThread):
+    """Dumps the card on `reader` off the GUI thread.
+
+    `progress` carries (sectors read, sectors total, key attempts, elapsed
+    seconds) and is throttled so a large key dictionary doesn't flood the
+    event loop. Sectors are read by priority within the optional `budget`
+    seconds; `preview` carries the record fields decodable so far after
+    every sector, `dumped` the DumpResult (also a partial one when the card
+    is pulled away or time runs out), `failed` an error message.
+    """
+
+    progress = QtCore.pyqtSignal(int, int, int, float)
+    preview = QtCore.pyqtSignal(dict)
+    dumped = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, key_store, reader, budget=None, parent=None):
+        super().__init__(parent)
+        self.key_store = key_store
+        self.reader = reader
+        self.budget = budget
+        self._cancel = threading.Event()
+        self._started = 0.0
+        self._last_progress = 0.0
+        self._last_opened = -1
+
+    def cancel(self):
+        self._cancel.set()
+
+    def report(self, opened: int, total: int, attempts: int):
+        now = monotonic()
+        if opened != self._last_opened or now - self._last_progress >= 0.1:
+            self._last_opened = opened
+            self._last_progress = now
+            self.progress.emit(opened, total, attempts, now - self._started)
+
+    def run(self):
+        # The reader layer (pyscard) is only imported once a dump is made
+        from smartcard.Exceptions import NoCardException, CardConnectionException
+        from acr122ulib import PresenceMonitor, ReaderSession
+        from dumper import dump_progressive, sector_count
+
+        self._started = monotonic()
+        try:
+            with PresenceMonitor(self.reader) as monitor:
+                self.report(0, 0, 0)
+                while not monitor.wait(present=True, timeout=0.5):
+                    if self._cancel.is_set():
+                        return
+        except CardConnectionException as e:
+            self.failed.emit(str(e))
+            return
+        with ReaderSession(self.reader) as session:
+            connected = session.connect(attempts=1, interval=0)
+            if connected != True:
+                self.failed.emit("Ошибка соединения!")
+                return
+            try:
+                count = sector_count(session.getinfo())
+
+                def publish(sector, card):
+                    fields = available_fields(card.dump.sectors, count)
+                    if fields:  # nothing to show before the sectors of some field are read
+                        self.preview.emit(card.to_dict(fields))
+
+                result = dump_progressive(session, self.key_store, self.budget, publish,
+                                          progress=self.report, cancel=self._cancel)
+            except (NoCardException, CardConnectionException):
+                self.failed.emit("Карта убрана с ридера!")
+                return
+        if self._cancel.is_set():
+            return
+        if result.error:
+            self.failed.emit(result.error)
+        if result.sectors:
+            self.dumped.emit(result)
+
+
+class BalanceThread(QtCore.QThread):
+    """Reads just the number and balance of the card on `reader` through a
+    LiveCard, sectors 0 and 4 instead of a full dump.
+
+    `read` carries the record, `failed` an error message.
+    """
+
+    read = QtCore.pyqtSignal(dict)
+    failed = QtCore.pyqtSignal(str)
+
+    FIELDS = ("number", "balance")
+
+    def __init__(self, key_store, reader, parent=None):
+        super().__init__(parent)
+        self.key_store = key_store
+        self.reader = reader
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        from smartcard.Exceptions import NoCardException, CardConnectionException
+        from acr122ulib import ReaderSession
+        from dumper import LiveCard
+
+        with ReaderSession(self.reader) as session:
+            if session.connect(attempts=1, interval=0) != True:
+                self.failed.emit("Ошибка соединения!")
+                return
+            try:
+                card = LiveCard(session, self.key_store, self._cancel)
+                if "MIFARE" not in card.info["Name"]:
+                    self.failed.emit("Карта не MIFARE!")
+                    return
+                record = card.to_dict(self.FIELDS)
+            except (NoCardException, CardConnectionException):
+                self.failed.emit("Карта убрана с ридера!")
+                return
+        if self._cancel.is_set():
+            return
+        if len(record) < len(self.FIELDS):
+            self.failed.emit("Ключ к сектору баланса не найден!")
+        if record:
+            self.read.emit(record)
+
+
+class KioskThread(QtCore.QThread):
+    """Continuously dumps every card tapped on any of `readers`.
+
+    Waiting for cards happens in PC/SC status-change notifications, so an
+    idle kiosk uses no CPU. With a DumpStore, cards seen before only get
+    their changing sectors re-read. Every finished dump is emitted as `dumped`.
+    """
+
+    dumped = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, key_store, readers=None, store=None, parent=None):
+        super().__init__(parent)
+        from dumper import DumpEngine
+
+        self.engine = DumpEngine(key_store, readers, store=store)
+
+    def cancel(self):
+        self.engine.stop_event.set()
+
+    def run(self):
+        with self.engine:
+            for result in self.engine:
+                if result.error:
+                    self.failed.emit(f"{result.reader}: {result.error}")
+                else:
+                    self.dumped.emit(result)
+
+
+class ParseThread(QtCore.QThread):
+    """Loads and decodes a dump file off the GUI thread.
+
+    `parsed` carries the Card, its to_dict() record and the file's
+    modification date. With a ParseCache a dump opened before isn't
+    decoded again.
+    """
+
+    parsed = QtCore.pyqtSignal(object, dict, str)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, path: str, cache: ParseCache = None, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.cache = cache
+
+    def run(self):
+        try:
+            card = Card.from_file(self.path)
+        except FileNotFoundError as e:
+            self.failed.emit('Файл не найден!\n' + str(self.path) + "\n" + str(e))
+            return
+        except OSError as e:
+            self.failed.emit(str(e))
+            return
+        created = datetime.fromtimestamp(
+            os.path.getmtime(self.path)).strftime('%Y-%m-%d %H:%M:%S')
+        if self.cache is not None:
+            try:
+                record = self.cache.record(card)
+            finally:
+                self.cache.close()
+            error = record.pop("error")
+            if error and error.startswith(INVALID):
+                self.failed.emit('Файл не является валидным дампом!\n' + error)
+            elif error:
+                self.failed.emit(f"Ошибка разбора дампа: {error}")
+            else:
+                self.parsed.emit(card, record, created)
+            return
+        reason = card.validate()
+        if reason:
+            self.failed.emit('Файл не является валидным дампом!\n' + INVALID + reason)
+            return
+        try:
+            record = card.to_dict()
+        except Exception as e:
+            self.failed.emit(f"Ошибка разбора дампа: {e}")
+            return
+        self.parsed.emit(card, record, created)
+
+
+class DirectoryThread(QtCore.QThread):
+    """Lists the dump files under `directory` off the GUI thread.
+
+    `found` carries the paths in batches, at most one every `interval`
+    seconds, so a table fills while a large tree is still being walked.
+    """
+
+    found = QtCore.pyqtSignal(list)
+
+    def __init__(self, directory: str, interval=0.1, parent=None):
+        super().__init__(parent)
+        self.directory = directory
+        self.interval = interval
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        paths = []
+        last = monotonic()
+        for path in iter_dump_paths([self.directory]):
+            if self._cancel.is_set():
+                return
+            paths.append(path)
+            now = monotonic()
+            if now - last >= self.interval:
+                self.found.emit(paths)
+                paths = []
+                last = now
+        if paths:
+            self.found.emit(paths)
+
+
+class DecodeThread(QtCore.QThread):
+    """Decodes (row, path) pairs in batch worker processes.
+
+    `decoded` carries lists of (row, record) at most every `interval`
+    seconds rather than one signal per dump. With `cache_path` dumps
+    decoded before come from that ParseCache.
+    """
+
+    decoded = QtCore.pyqtSignal(list)
+
+    def __init__(self, rows: list, cache_path: str = None, interval=0.2, parent=None):
+        super().__init__(parent)
+        self.rows = rows
+        self.cache_path = cache_path
+        self.interval = interval
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        # A process pool only pays off past a few hundred dumps
+        workers = 1 if len(self.rows) < 512 else None
+        # Forking a process with Qt's threads running can deadlock the children
+        records = parse_files((path for row, path in self.rows), workers,
+                              cache_path=self.cache_path,
+                              mp_context=multiprocessing.get_context("spawn"))
+        chunk = []
+        last = monotonic()
+        try:
+            for (row, path), record in zip(self.rows, records):
+                if self._cancel.is_set():
+                    return
+                chunk.append((row, record))
+                now = monotonic()
+                if now - last >= self.interval:
+                    self.decoded.emit(chunk)
+                    chunk = []
+                    last = now
+            if chunk:
+                self.decoded.emit(chunk)
+        finally:
+            records.close()